@@ -0,0 +1,410 @@
+"""
+قياس أداء دوال قاعدة البيانات ومنطق البطولة على قاعدة بيانات مؤقتة ببيانات اصطناعية.
+
+يعمل دون اتصال: استدعاءات تيليجرام وجلب الأسئلة من opentdb مستبدلة ببدائل وهمية.
+
+    python benchmarks/bench_bot.py                                   # قياس ومقارنة مع baseline.json
+    python benchmarks/bench_bot.py --update-baseline finalize_match  # تحديث خط الأساس لعمليات بعينها
+    python benchmarks/bench_bot.py --update-baseline                 # إعادة كتابة خط الأساس كاملاً
+    python benchmarks/bench_bot.py --scales 8,64,512 --answers 2000000
+
+كل عملية تُشغَّل مرة للإحماء ثم تؤخذ --repeat عينات موزعة على جولات؛ العينة تكرر العملية حتى
+يبلغ زمنها --min-sample ثانية على الأقل، وزمنها هو المتوسط لكل تشغيل. يُحفظ أفضل زمن مقسوماً على أسرع
+زمن للحمل المرجعي (reference.py)، وهو يُقاس قبل كل عينة طوال التشغيل: الحمل المرجعي قصير
+فيتذبذب كثيراً في القياس الواحد، وأسرعه عبر مئات القياسات ثابت ويعبر عن سرعة الجهاز.
+ويُحفظ أكبر عدد استعلامات لتشغيل واحد.
+يخرج برمز 1 إذا زاد عدد الاستعلامات لأي عملية (مقياس حتمي)، أو إذا زاد زمنها النسبي بأكثر من
+--threshold، ويُفحص الزمن فقط للعمليات التي يتجاوز زمنها في خط الأساس --noise-floor
+(بوحدات الحمل المرجعي)؛ ما دونها يتذبذب أكثر من الحد المسموح.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+from reference import reference_seconds  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PLAYERS_PER_TEAM = 5
+QUESTIONS_PER_MATCH = 25
+DB_EXECUTE_CALLS = 1000
+
+
+# ------------------ بدائل تيليجرام ------------------
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        return types.SimpleNamespace(chat_id=chat_id, message_id=1)
+
+    async def edit_message_text(self, text, **kwargs):
+        return None
+
+
+class FakeMessage:
+    async def reply_text(self, text, **kwargs):
+        return types.SimpleNamespace(chat_id=bot.OWNER_ID, message_id=1)
+
+
+def fake_update(user_id: int = bot.OWNER_ID):
+    return types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=user_id, username=None, first_name="bench"),
+        effective_chat=types.SimpleNamespace(id=user_id),
+        message=FakeMessage(),
+    )
+
+
+def fake_context(args: Optional[List[str]] = None):
+    return types.SimpleNamespace(bot=FakeBot(), bot_data={}, user_data={}, args=args or [], job_queue=None)
+
+
+def fake_fetch_questions(amount: int = QUESTIONS_PER_MATCH, difficulty_boost: float = 1.0) -> List[Dict]:
+    return [{'question': f"q{i}", 'correct': "A", 'options': ["A", "B", "C", "D"], 'difficulty': "easy"}
+            for i in range(amount)]
+
+
+# ------------------ عداد الاستعلامات ------------------
+class QueryCounter:
+    """
+    يعد كل جملة SQL تنفذها الاتصالات المفتوحة عبر sqlite3.connect ما دام مثبتاً.
+    يُثبَّت مرة واحدة قبل bot.database.start() لأن خيوط قاعدة البيانات تفتح اتصالاتها
+    عند أول استخدام وتبقيها، ويقيس measure الفرق قبل العملية وبعدها.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._connect = sqlite3.connect
+
+    def _on_statement(self, _sql):
+        self.count += 1
+
+    def __enter__(self):
+        def connect(*args, **kwargs):
+            conn = self._connect(*args, **kwargs)
+            conn.set_trace_callback(self._on_statement)
+            return conn
+        sqlite3.connect = connect
+        return self
+
+    def __exit__(self, *exc):
+        sqlite3.connect = self._connect
+
+
+# ------------------ البيانات الاصطناعية ------------------
+def raw_connect() -> sqlite3.Connection:
+    return sqlite3.connect(bot.DB_PATH)
+
+
+def populate_teams(n_teams: int):
+    conn = raw_connect()
+    with conn:
+        for table in ("user_team", "users", "teams", "matches", "team_stats", "tournament", "chat_groups",
+                      "tournament_teams"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT INTO teams (id, name, active) VALUES (?, ?, 1)",
+                         [(tid, f"team{tid}") for tid in range(1, n_teams + 1)])
+        # كل الفرق في بطولة محادثة المالك، حيث تُنفذ أوامر المقاييس
+        conn.execute("INSERT INTO chat_groups (id, chat_id) VALUES (1, ?)", (bot.OWNER_ID,))
+        conn.executemany("INSERT INTO tournament_teams (tournament_id, team_id) VALUES (1, ?)",
+                         [(tid,) for tid in range(1, n_teams + 1)])
+        users = [(tid * 1000 + p, tid) for tid in range(1, n_teams + 1) for p in range(PLAYERS_PER_TEAM)]
+        conn.executemany("INSERT INTO users (user_id, first_name, lang) VALUES (?, 'bench', 'ar')",
+                         [(uid,) for uid, _tid in users])
+        conn.executemany("INSERT INTO user_team (user_id, team_id) VALUES (?, ?)", users)
+    conn.close()
+    bot.warm_caches()
+    bot.tournament_ids.clear()
+
+
+def populate_answers(n_answers: int):
+    """
+    صفوف player_answers لمباريات سابقة وهمية (أرقام سالبة كي لا تتصادم مع المباريات الفعلية)،
+    مع صف match_questions لكل إجابة كي تجد المعايرة ما تربطه، وصف match_participants لكل لاعب
+    (فريقان في كل مباراة) كي تُحسب منحنيات دقة الفرق.
+    """
+    conn = raw_connect()
+    have = conn.execute("SELECT COUNT(*) FROM player_answers").fetchone()[0]
+    if have < n_answers:
+        rng = random.Random(1)
+        per_match = QUESTIONS_PER_MATCH * 2
+
+        def rows():
+            for i in range(have, n_answers):
+                match_id = -(i // per_match) - 1
+                yield (match_id, 1000 + i % per_match, i % per_match, "A", rng.random() < 0.6)
+        def questions():
+            for i in range(have, n_answers):
+                yield (-(i // per_match) - 1, i % per_match, f"bench q{i * 7919 % 5000}",
+                       ("easy", "medium", "hard")[i % 3], "2026-01-01 00:00:00")
+        def participants():
+            for i in range(have, n_answers):
+                yield (-(i // per_match) - 1, 1000 + i % per_match, i % 2 + 1)
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO match_participants (match_id, user_id, team_id) VALUES (?, ?, ?)",
+                             participants())
+            conn.executemany("INSERT INTO player_answers (match_id, user_id, question_index, answer, is_correct) "
+                             "VALUES (?, ?, ?, ?, ?)", rows())
+            conn.executemany("INSERT INTO match_questions (match_id, question_index, question_text, difficulty, asked_at) "
+                             "VALUES (?, ?, ?, ?, ?)", questions())
+    conn.close()
+
+
+# ------------------ العمليات المقاسة ------------------
+def run(coro):
+    return asyncio.run(coro)
+
+
+def op_db_execute(_scale: int) -> Callable[[], int]:
+    def op():
+        for i in range(DB_EXECUTE_CALLS):
+            bot.db_execute("SELECT lang FROM users WHERE user_id = ?", (1000 + i,))
+        return DB_EXECUTE_CALLS
+    return op
+
+
+def op_db_fetch(_scale: int) -> Callable[[], int]:
+    async def fetch_all():
+        await asyncio.gather(*(bot.database.fetch("SELECT lang FROM users WHERE user_id = ?", (1000 + i % 50,))
+                               for i in range(DB_EXECUTE_CALLS)))
+
+    def op():
+        run(fetch_all())
+        return DB_EXECUTE_CALLS
+    return op
+
+
+def op_init_db(_scale: int) -> Callable[[], int]:
+    def op():
+        bot.init_db()
+        return 1
+    return op
+
+
+def op_start_tournament(_scale: int) -> Callable[[], int]:
+    def op():
+        run(bot.owner_start_tournament(fake_update(), fake_context()))
+        return 1
+    return op
+
+
+def setup_active_match(context) -> int:
+    """أول مباراة مجموعات مع 25 سؤالاً مُجاباً عليها، جاهزة لـ finalize_match."""
+    match_id, tournament_id, team1_id, team2_id = bot.db_execute(
+        "SELECT id, tournament_id, team1_id, team2_id FROM matches WHERE phase='group' ORDER BY id LIMIT 1")[0]
+    bot.db_execute("UPDATE matches SET played=0, status='active' WHERE id=?", (match_id,))
+    bot.db_execute("DELETE FROM player_answers WHERE match_id=?", (match_id,))
+    team1_players, team2_players = bot.get_team_players(team1_id), bot.get_team_players(team2_id)
+    players = team1_players + team2_players
+    conn = raw_connect()
+    with conn:
+        conn.executemany("INSERT INTO player_answers (match_id, user_id, question_index, answer, is_correct) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(match_id, players[q % len(players)], q, "A", q % 3 != 0)
+                          for q in range(QUESTIONS_PER_MATCH)])
+    conn.close()
+    context.bot_data['active_matches'] = {match_id: {
+        'tournament_id': tournament_id,
+        'questions': fake_fetch_questions(),
+        'team1_id': team1_id,
+        'team2_id': team2_id,
+        'team1_name': bot.get_team_name(team1_id),
+        'team2_name': bot.get_team_name(team2_id),
+        'players': players,
+        'team1_players': team1_players,
+        'team2_players': team2_players,
+        'current_question': 0,
+        'answered_questions': set(range(QUESTIONS_PER_MATCH)),
+    }}
+    return match_id
+
+
+def op_finalize_match(_scale: int) -> Callable[[], int]:
+    context = fake_context()
+    match_id = setup_active_match(context)
+
+    def op():
+        run(bot.finalize_match(context, match_id))
+        return 1
+    return op
+
+
+def op_check_and_advance(_scale: int) -> Callable[[], int]:
+    tournament_id = run(bot.get_tournament_id(bot.OWNER_ID))
+    bot.db_execute("DELETE FROM matches WHERE phase='knockout'")
+    bot.db_execute("UPDATE matches SET played=1, status='finished' WHERE phase='group'")
+    bot.db_execute("UPDATE tournament SET value='group' WHERE key='phase'")
+
+    def op():
+        run(bot.check_and_advance_knockout(fake_context(), tournament_id))
+        return 1
+    return op
+
+
+def op_question_analytics(_scale: int) -> Callable[[], int]:
+    def op():
+        return bot.compute_question_analytics()['answers']
+    return op
+
+
+# الترتيب مهم: finalize و check_and_advance تحتاجان مباريات أنشأها start_tournament
+OPERATIONS = [
+    ("db_execute", op_db_execute),
+    ("db_fetch", op_db_fetch),
+    ("init_db", op_init_db),
+    ("start_tournament", op_start_tournament),
+    ("finalize_match", op_finalize_match),
+    ("check_and_advance_knockout", op_check_and_advance),
+    ("question_analytics", op_question_analytics),
+]
+
+
+def sample(scale: int, factory, min_sample: float, counter: QueryCounter) -> tuple:
+    """عينة واحدة: (متوسط زمن التشغيل، ناتج العملية، أكبر عدد استعلامات لتشغيل واحد)."""
+    # العمليات القصيرة تُكرر حتى min_sample كي لا تطغى دقة المؤقت وتذبذب الجدولة على العينة
+    elapsed, runs, queries, ops = 0.0, 0, 0, 0
+    while runs == 0 or elapsed < min_sample:
+        op = factory(scale)
+        before = counter.count
+        start = time.perf_counter()
+        ops = op()
+        elapsed += time.perf_counter() - start
+        queries = max(queries, counter.count - before)
+        runs += 1
+    return elapsed / runs, ops, queries
+
+
+def measure(scale: int, repeat: int, min_sample: float, counter: QueryCounter) -> tuple:
+    """
+    كل العمليات على مقياس واحد؛ تعيد النتائج وأزمنة الحمل المرجعي المقاسة قبل كل عينة.
+    العينات تؤخذ في جولات (عينة لكل عملية في كل جولة) لا متتالية للعملية الواحدة، كي تتوزع
+    عينات كل عملية على فترات تباطؤ الجهاز العابرة بدل أن تقع كلها في إحداها.
+    """
+    # جولة إحماء لا تُحسب: أول تشغيل ينشئ ما تخزنه الذاكرة (رقم البطولة مثلاً)
+    for _name, factory in OPERATIONS:
+        factory(scale)()
+    samples = {name: [] for name, _factory in OPERATIONS}
+    queries = dict.fromkeys(samples, 0)
+    ops, references = {}, []
+    for _ in range(repeat):
+        for name, factory in OPERATIONS:
+            references.append(reference_seconds(repeat=2))
+            seconds, ops[name], q = sample(scale, factory, min_sample, counter)
+            samples[name].append(seconds)
+            queries[name] = max(queries[name], q)
+    results = []
+    for name, _factory in OPERATIONS:
+        best = min(samples[name])
+        results.append({
+            'op': name,
+            'scale': scale,
+            'seconds': best,
+            'ops': ops[name],
+            'throughput': ops[name] / best if best > 0 else float('inf'),
+            'queries': queries[name],
+        })
+    return results, references
+
+
+# ------------------ التشغيل ------------------
+def compare(results: List[Dict], baseline: Dict, threshold: float, noise_floor: float) -> List[str]:
+    regressions = []
+    for r in results:
+        key = f"{r['op']}@{r['scale']}"
+        base = baseline.get('results', {}).get(key)
+        if not base:
+            continue
+        if base['relative'] >= noise_floor and r['relative'] > base['relative'] * (1 + threshold):
+            regressions.append(f"{key}: الزمن النسبي {r['relative']:.4f} مقابل {base['relative']:.4f}")
+        if r['queries'] > base['queries']:
+            regressions.append(f"{key}: الاستعلامات {r['queries']} مقابل {base['queries']}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="8,64,256", help="أعداد الفرق مفصولة بفواصل")
+    parser.add_argument("--answers", type=int, default=1_000_000, help="عدد صفوف player_answers الاصطناعية")
+    parser.add_argument("--repeat", type=int, default=7, help="عدد العينات لكل عملية")
+    parser.add_argument("--min-sample", type=float, default=0.2, help="أقل زمن للعينة الواحدة بالثواني")
+    parser.add_argument("--noise-floor", type=float, default=0.5,
+                        help="أقل زمن نسبي في خط الأساس يُفحص زمن العملية عنده")
+    parser.add_argument("--threshold", type=float, default=0.25, help="نسبة الزيادة المسموح بها في الزمن النسبي")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", nargs="*", metavar="OP",
+                        help="حفظ نتائج العمليات المذكورة في خط الأساس (كلها إن لم تُذكر عمليات)")
+    args = parser.parse_args(argv)
+    names = [name for name, _factory in OPERATIONS]
+    unknown = set(args.update_baseline or ()) - set(names)
+    if unknown:
+        parser.error(f"عمليات غير معروفة: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory(prefix="frek-bench-") as workdir:
+        results, reference = run_all(workdir, args)
+    for r in results:
+        r['relative'] = r['seconds'] / reference
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.update_baseline is not None:
+        update = set(args.update_baseline or names)
+        merged = dict(baseline.get('results', {})) if args.update_baseline else {}
+        merged.update({f"{r['op']}@{r['scale']}": r for r in results if r['op'] in update})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'answers': args.answers,
+                'reference_seconds': reference,
+                'results': merged,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"حُفظ خط الأساس في {args.baseline}: {', '.join(sorted(update))}")
+        return 0
+    if not baseline:
+        print("لا يوجد خط أساس؛ شغّل مع --update-baseline لإنشائه.")
+        return 0
+    regressions = compare(results, baseline, args.threshold, args.noise_floor)
+    for line in regressions:
+        print(f"❌ تراجع: {line}")
+    return 1 if regressions else 0
+
+
+def run_all(workdir: str, args) -> tuple:
+    """كل العمليات على كل المقاييس في workdir؛ تعيد النتائج وأسرع زمن للحمل المرجعي."""
+    bot.DB_PATH = os.path.join(workdir, "tournament.db")
+    bot.answer_journal.path = os.path.join(workdir, "answers.journal")
+    bot.ARCHIVE_PATH = os.path.join(workdir, "archives")
+    bot.fetch_questions = fake_fetch_questions
+    random.seed(0)
+
+    bot.init_db()
+    populate_answers(args.answers)
+    counter = QueryCounter().__enter__()
+    bot.database.start(bot.DB_PATH)
+    results, references = [], []
+    try:
+        for scale in [int(s) for s in args.scales.split(",")]:
+            populate_teams(scale)
+            scale_results, scale_references = measure(scale, args.repeat, args.min_sample, counter)
+            references += scale_references
+            for r in scale_results:
+                print(f"{r['op']:<28} teams={scale:<6} {r['seconds'] * 1000:10.2f} ms "
+                      f"{r['throughput']:12.2f} ops/s {r['queries']:8d} queries", flush=True)
+            results += scale_results
+    finally:
+        bot.database.close()
+        counter.__exit__()
+    return results, min(references)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
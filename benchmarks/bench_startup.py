@@ -0,0 +1,173 @@
+"""
+قياس زمن تشغيل bot.py حتى الجاهزية لأول تحديث، كل مرة في عملية فرعية جديدة (استيراد بارد).
+
+    python benchmarks/bench_startup.py                            # قياس ومقارنة مع startup_baseline.json
+    python benchmarks/bench_startup.py --update-baseline restart  # تحديث خط الأساس لحالة بعينها
+    python benchmarks/bench_startup.py --update-baseline          # إعادة كتابة خط الأساس كاملاً
+    python benchmarks/bench_startup.py --users 200000 --teams 512
+
+المراحل: import، startup (init_db وسجل الإجابات وتعبئة الذاكرة)، build_application
+(ومعه استيراد telegram.ext)، و ready (مجموع الثلاث: الزمن حتى الجاهزية لأول تحديث)،
+و process (زمن العملية كاملاً بما فيه بدء المفسر). تُقاس في حالتين:
+cold على قاعدة جديدة، و restart على قاعدة موجودة ببيانات اصطناعية.
+لا اتصال بتيليجرام: التطبيق يُبنى فقط ولا يُشغَّل.
+
+التشغيلات تتناوب بين الحالتين في --repeat جولات، ويُقاس الحمل المرجعي (reference.py) قبل كل
+تشغيل. الزمن النسبي المحفوظ لكل مرحلة هو وسيط نسب التشغيلات إلى الحمل المرجعي الذي سبقها،
+كي تصلح المقارنة على أجهزة مختلفة وتتبع تغير سرعة الجهاز أثناء التشغيل. يخرج برمز 1 إذا زاد الزمن النسبي لمرحلة بأكثر من --threshold مقارنة بخط الأساس،
+ويُفحص الزمن فقط للمراحل التي يتجاوز زمنها في خط الأساس --noise-floor (بوحدات الحمل المرجعي).
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from reference import reference_seconds
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+PLAYERS_PER_TEAM = 5
+PHASES = ("import", "startup", "build_application", "ready", "process")
+SCENARIOS = ("cold", "restart")
+
+# يُنفَّذ في العملية الفرعية: المعامل الأول مجلد العمل (فيه tournament.db)
+CHILD = """
+import json, os, sys, time
+t0 = time.perf_counter()
+os.chdir(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+import bot
+t1 = time.perf_counter()
+bot.startup()
+t2 = time.perf_counter()
+bot.build_application()
+t3 = time.perf_counter()
+bot.database.close()
+print(json.dumps({'import': t1 - t0, 'startup': t2 - t1, 'build_application': t3 - t2, 'ready': t3 - t0}))
+"""
+
+
+def run_child(workdir: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, "-W", "ignore", "-c", CHILD, workdir, ROOT],
+                         check=True, capture_output=True, text=True).stdout
+    timings = json.loads(out.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - start
+    return timings
+
+
+def populate(workdir: str, n_teams: int, n_users: int):
+    """فرق ومستخدمون وعضويات اصطناعية في قاعدة أنشأها تشغيل سابق."""
+    conn = sqlite3.connect(os.path.join(workdir, "tournament.db"))
+    with conn:
+        conn.executemany("INSERT INTO teams (id, name, active) VALUES (?, ?, 1)",
+                         [(tid, f"team{tid}") for tid in range(1, n_teams + 1)])
+        conn.executemany("INSERT INTO users (user_id, first_name, lang) VALUES (?, 'bench', ?)",
+                         [(uid, 'ar' if uid % 3 else 'en') for uid in range(1, n_users + 1)])
+        members = min(n_users, n_teams * PLAYERS_PER_TEAM)
+        conn.executemany("INSERT INTO user_team (user_id, team_id) VALUES (?, ?)",
+                         [(uid, uid % n_teams + 1) for uid in range(1, members + 1)])
+    conn.close()
+
+
+def best(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    return {phase: min(r[phase] for r in runs) for phase in PHASES}
+
+
+def median_relative(runs: List[Dict[str, float]], references: List[float]) -> Dict[str, float]:
+    return {phase: statistics.median(r[phase] / ref for r, ref in zip(runs, references)) for phase in PHASES}
+
+
+def compare(relative: Dict[str, Dict[str, float]], baseline: Dict, threshold: float,
+            noise_floor: float) -> List[str]:
+    regressions = []
+    for scenario, phases in relative.items():
+        base = baseline.get('relative', {}).get(scenario, {})
+        for phase, value in phases.items():
+            if phase in base and base[phase] >= noise_floor and value > base[phase] * (1 + threshold):
+                regressions.append(f"{scenario}.{phase}: الزمن النسبي {value:.3f} مقابل {base[phase]:.3f}")
+    return regressions
+
+
+def run_all(args) -> tuple:
+    """أفضل الأزمنة لكل حالة، والأزمنة النسبية، ووسيط الحمل المرجعي المقاس قبل كل تشغيل."""
+    cold, restart, cold_refs, restart_refs = [], [], [], []
+    with tempfile.TemporaryDirectory(prefix="frek-start-") as restart_dir:
+        run_child(restart_dir)
+        populate(restart_dir, args.teams, args.users)
+        # تشغيل إحماء لكل حالة (ذاكرة نظام الملفات للمفسر والمكتبات)، ثم جولات متناوبة
+        # كي لا تقع كل تشغيلات حالة واحدة في فترة تباطؤ عابرة للجهاز
+        run_child(restart_dir)
+        for i in range(args.repeat + 1):
+            reference = reference_seconds(repeat=2)
+            with tempfile.TemporaryDirectory(prefix="frek-start-") as workdir:
+                timings = run_child(workdir)
+            if i:
+                cold.append(timings)
+                cold_refs.append(reference)
+            restart_refs.append(reference_seconds(repeat=2))
+            restart.append(run_child(restart_dir))
+    return ({'cold': best(cold), 'restart': best(restart)},
+            {'cold': median_relative(cold, cold_refs), 'restart': median_relative(restart, restart_refs)},
+            statistics.median(cold_refs + restart_refs))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--teams", type=int, default=256)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--threshold", type=float, default=0.25, help="نسبة الزيادة المسموح بها في الزمن النسبي")
+    parser.add_argument("--noise-floor", type=float, default=2.0,
+                        help="أقل زمن نسبي في خط الأساس يُفحص زمن المرحلة عنده")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", nargs="*", metavar="SCENARIO",
+                        help="حفظ نتائج الحالات المذكورة في خط الأساس (كلها إن لم تُذكر حالات)")
+    args = parser.parse_args(argv)
+    unknown = set(args.update_baseline or ()) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"حالات غير معروفة: {', '.join(sorted(unknown))}")
+
+    results, relative, reference = run_all(args)
+    for scenario, phases in results.items():
+        print(f"{scenario:<8} " + "  ".join(f"{phase}={seconds * 1000:8.1f} ms" for phase, seconds in phases.items()))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.update_baseline is not None:
+        update = set(args.update_baseline or SCENARIOS)
+        saved = {key: dict(baseline.get(key, {})) if args.update_baseline else {} for key in ('results', 'relative')}
+        for scenario in update:
+            saved['results'][scenario] = results[scenario]
+            saved['relative'][scenario] = relative[scenario]
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'teams': args.teams,
+                'users': args.users,
+                'reference_seconds': reference,
+                **saved,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"حُفظ خط الأساس في {args.baseline}: {', '.join(sorted(update))}")
+        return 0
+    if not baseline:
+        print("لا يوجد خط أساس؛ شغّل مع --update-baseline لإنشائه.")
+        return 0
+    regressions = compare(relative, baseline, args.threshold, args.noise_floor)
+    for line in regressions:
+        print(f"❌ تراجع: {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
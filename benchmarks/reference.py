@@ -0,0 +1,33 @@
+"""
+حمل مرجعي ثابت يُقاس في نفس تشغيل المقاييس؛ تُقسم عليه الأزمنة كي تُقارن خطوط الأساس
+بين أجهزة مختلفة السرعة (الأزمنة المحفوظة نسبية لا مطلقة).
+"""
+import sqlite3
+import time
+
+ROWS = 20_000
+
+
+def _workload():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, k INTEGER, v TEXT)")
+    with conn:
+        conn.executemany("INSERT INTO t (k, v) VALUES (?, ?)", ((i * 7919 % 1000, f"v{i}") for i in range(ROWS)))
+    conn.execute("CREATE INDEX idx_t_k ON t(k)")
+    for k in range(0, 1000, 10):
+        conn.execute("SELECT COUNT(*), MAX(v) FROM t WHERE k = ?", (k,)).fetchone()
+    totals = {}
+    for _id, k, v in conn.execute("SELECT id, k, v FROM t"):
+        totals[k] = totals.get(k, 0) + len(v)
+    conn.close()
+    return sorted(totals.items())
+
+
+def reference_seconds(repeat: int = 5) -> float:
+    """أفضل زمن من repeat تشغيلات للحمل المرجعي."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _workload()
+        best = min(best, time.perf_counter() - start)
+    return best
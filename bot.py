@@ -1,46 +1,161 @@
+from __future__ import annotations
+
+import time
+
+STARTED_AT = time.perf_counter()  # لقياس زمن التشغيل حتى أول تحديث
+
 import os
 import logging
+import logging.handlers
+import queue
+import gzip
 import random
 import sqlite3
-import requests
 import json
-import io
-import csv
-import shutil
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    JobQueue,
-)
+import asyncio
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+# telegram و requests تُستورد عند أول استخدام؛ هنا للتلميحات فقط
+if TYPE_CHECKING:
+    from telegram import InlineKeyboardMarkup, Update
+    from telegram.ext import Application, ContextTypes
 
 # ------------------ الإعدادات الأساسية ------------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8653217576:AAEzoImMB5C9dbUtAbHrmm3cumxMd653udk")
 OWNER_ID = int(os.environ.get("OWNER_ID", "5324135896"))
 DB_PATH = "tournament.db"
+SCHEMA_VERSION = 5  # يُرفع مع كل تغيير في init_db كي يُعاد تطبيقه على القواعد الموجودة
 BACKUP_PATH = "backups/"
+ARCHIVE_PATH = "archives/"
+DB_READERS = 4
+JOURNAL_PATH = "answers.journal"
+JOURNAL_FLUSH_INTERVAL = 0.005  # ثوانٍ
+JOURNAL_MAX_BATCH = 64
+BROADCAST_BATCH = 25
+BROADCAST_DELAY = 0.05  # ثوانٍ بين الرسائل (حد تيليجرام ~30 رسالة/ثانية)
+BROADCAST_PROGRESS_EVERY = 10  # تحديث رسالة التقدم كل 10 دفعات
+MATCHES_PAGE_SIZE = 20
+RATING_BASE = 1500.0
+RATING_K = 32.0
+RATING_SCALE = 400.0
+ANALYTICS_CHUNK = 100_000  # صفوف إجابات لكل دفعة قراءة
+CALIBRATION_MIN_ANSWERS = 30  # أقل عدد إجابات لاعتماد النسبة المرصودة لتسمية صعوبة
+CALIBRATION_INTERVAL = 24 * 60 * 60  # ثوانٍ
+COMPACTION_INTERVAL = 6 * 60 * 60  # ثوانٍ بين محاولات ضغط القاعدة عند الخمول
+# نسب النجاح الاسمية لتسميات opentdb، تُستخدم قبل توفر بيانات كافية
+NOMINAL_SUCCESS = {'easy': 0.75, 'medium': 0.55, 'hard': 0.35}
 LANGUAGES = {'ar': 'العربية', 'en': 'English'}
 DEFAULT_LANG = 'ar'
 
-# إعداد تسجيل متقدم
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+LOG_PATH = "bot.log"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text أو json
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN")  # مثل midnight لتدوير زمني بدل الحجم
+LOG_BACKUP_COUNT = 7
+
 logger = logging.getLogger(__name__)
 
+# ------------------ التسجيل ------------------
+class JsonFormatter(logging.Formatter):
+    """سطر JSON لكل سجل، مع match_id و user_id إن مُررا عبر extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('match_id', 'user_id'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    يضع السجل في الطابور كما هو؛ التنسيق يتم في خيط المستمع لا في حلقة الأحداث.
+    لذلك يجب ألا تُمرر للسجلات معاملات قابلة للتعديل لاحقاً.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _gzip_rotator(source: str, dest: str):
+    import shutil
+
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    توجيه كل السجلات عبر طابور يفرغه خيط خلفي يكتب إلى الملف والطرفية.
+    الملف يُدوَّر بالحجم (أو بالوقت مع LOG_ROTATE_WHEN) وتُضغط النسخ القديمة بـ gzip.
+    """
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_PATH, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    listener.start()
+    return listener
+
 # ------------------ دوال قاعدة البيانات ------------------
+# كل بطولة مرتبطة بصف في chat_groups (محادثة واحدة = بطولة واحدة)، ورقمها هو chat_groups.id
+TEAM_STATS_SCHEMA = '''CREATE TABLE IF NOT EXISTS {name} (
+                    tournament_id INTEGER,
+                    team_id INTEGER,
+                    group_name TEXT,
+                    played INTEGER DEFAULT 0,
+                    wins INTEGER DEFAULT 0,
+                    draws INTEGER DEFAULT 0,
+                    losses INTEGER DEFAULT 0,
+                    points INTEGER DEFAULT 0,
+                    correct_answers INTEGER DEFAULT 0,
+                    eliminated BOOLEAN DEFAULT 0,
+                    PRIMARY KEY (tournament_id, team_id),
+                    FOREIGN KEY(tournament_id) REFERENCES chat_groups(id),
+                    FOREIGN KEY(team_id) REFERENCES teams(id))'''
+TOURNAMENT_SCHEMA = '''CREATE TABLE IF NOT EXISTS {name} (
+                    tournament_id INTEGER,
+                    key TEXT,
+                    value TEXT,
+                    PRIMARY KEY (tournament_id, key),
+                    FOREIGN KEY(tournament_id) REFERENCES chat_groups(id))'''
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
+    # المخطط مطابق للإصدار الحالي: لا حاجة لجمل الإنشاء والترحيل
+    if c.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        conn.close()
+        return
+    # يسري على قاعدة جديدة فقط؛ القاعدة القديمة تتحول في مهمة الضغط عند الخمول (compaction_job)
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
     c.execute('''CREATE TABLE IF NOT EXISTS teams (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT UNIQUE NOT NULL,
@@ -59,6 +174,7 @@ def init_db():
                     FOREIGN KEY(team_id) REFERENCES teams(id) ON DELETE CASCADE)''')
     c.execute('''CREATE TABLE IF NOT EXISTS matches (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tournament_id INTEGER,
                     phase TEXT NOT NULL,
                     round TEXT,
                     group_name TEXT,
@@ -73,16 +189,7 @@ def init_db():
                     FOREIGN KEY(team1_id) REFERENCES teams(id),
                     FOREIGN KEY(team2_id) REFERENCES teams(id),
                     FOREIGN KEY(winner_id) REFERENCES teams(id))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS team_stats (
-                    team_id INTEGER PRIMARY KEY,
-                    group_name TEXT,
-                    played INTEGER DEFAULT 0,
-                    wins INTEGER DEFAULT 0,
-                    draws INTEGER DEFAULT 0,
-                    losses INTEGER DEFAULT 0,
-                    points INTEGER DEFAULT 0,
-                    correct_answers INTEGER DEFAULT 0,
-                    FOREIGN KEY(team_id) REFERENCES teams(id))''')
+    c.execute(TEAM_STATS_SCHEMA.format(name='team_stats'))
     c.execute('''CREATE TABLE IF NOT EXISTS match_questions (
                     match_id INTEGER,
                     question_index INTEGER,
@@ -92,6 +199,7 @@ def init_db():
                     difficulty TEXT,
                     answered BOOLEAN DEFAULT 0,
                     answered_by INTEGER,
+                    asked_at TIMESTAMP,
                     PRIMARY KEY (match_id, question_index),
                     FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE)''')
     c.execute('''CREATE TABLE IF NOT EXISTS player_answers (
@@ -104,16 +212,186 @@ def init_db():
                     PRIMARY KEY (match_id, user_id, question_index),
                     FOREIGN KEY(match_id) REFERENCES matches(id) ON DELETE CASCADE,
                     FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS tournament (
-                    key TEXT PRIMARY KEY,
-                    value TEXT)''')
+    c.execute(TOURNAMENT_SCHEMA.format(name='tournament'))
     c.execute('''CREATE TABLE IF NOT EXISTS chat_groups (
                     id INTEGER PRIMARY KEY,
                     chat_id INTEGER UNIQUE)''')
+    # الفرق المشاركة في كل بطولة؛ الفريق نفسه (اسمه ولاعبوه) مشترك بين البطولات
+    has_tournament_teams = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tournament_teams'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS tournament_teams (
+                    tournament_id INTEGER,
+                    team_id INTEGER,
+                    PRIMARY KEY (tournament_id, team_id),
+                    FOREIGN KEY(tournament_id) REFERENCES chat_groups(id),
+                    FOREIGN KEY(team_id) REFERENCES teams(id))''')
+    # تشكيلة كل فريق عند بدء المباراة؛ يقيّم منها update_match و recompute_ratings اللاعبين
+    has_participants = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='match_participants'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS match_participants (
+                    match_id INTEGER,
+                    user_id INTEGER,
+                    team_id INTEGER,
+                    PRIMARY KEY (match_id, user_id))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ratings (
+                    kind TEXT NOT NULL,
+                    entity_id INTEGER NOT NULL,
+                    rating REAL NOT NULL,
+                    games INTEGER DEFAULT 0,
+                    PRIMARY KEY (kind, entity_id))''')
+    # ملخصات البطولات المؤرشفة؛ الصفوف التفصيلية في ملفات ARCHIVE_PATH
+    c.execute('''CREATE TABLE IF NOT EXISTS tournament_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tournament_id INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    matches INTEGER DEFAULT 0,
+                    answers INTEGER DEFAULT 0,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # ملخصات البطولات المؤرشفة التي يعيد منها /rerate و /calibrate حساباتهما
+    has_history = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='match_results'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS match_results (
+                    match_id INTEGER PRIMARY KEY,
+                    team1_id INTEGER,
+                    team2_id INTEGER,
+                    winner_id INTEGER)''')
+    # difficulty '' للأسئلة بلا تسمية، كي لا تتكرر الصفوف (NULL لا يتعارض في المفتاح)
+    c.execute('''CREATE TABLE IF NOT EXISTS question_totals (
+                    question_text TEXT,
+                    difficulty TEXT,
+                    answers INTEGER DEFAULT 0,
+                    correct INTEGER DEFAULT 0,
+                    PRIMARY KEY (question_text, difficulty))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS latency_totals (
+                    question_text TEXT,
+                    difficulty TEXT,
+                    seconds INTEGER,
+                    answers INTEGER DEFAULT 0,
+                    PRIMARY KEY (question_text, difficulty, seconds))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS team_match_totals (
+                    team_id INTEGER,
+                    match_id INTEGER,
+                    answers INTEGER,
+                    correct INTEGER,
+                    PRIMARY KEY (team_id, match_id))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS player_totals (
+                    user_id INTEGER PRIMARY KEY,
+                    matches INTEGER DEFAULT 0,
+                    correct INTEGER DEFAULT 0,
+                    wrong INTEGER DEFAULT 0)''')
+    # نتائج compute_question_analytics؛ تُستبدل بالكامل في كل معايرة
+    c.execute('''CREATE TABLE IF NOT EXISTS question_calibration (
+                    question_text TEXT PRIMARY KEY,
+                    difficulty TEXT,
+                    answers INTEGER,
+                    success_rate REAL,
+                    median_latency REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS difficulty_calibration (
+                    difficulty TEXT PRIMARY KEY,
+                    answers INTEGER,
+                    success_rate REAL,
+                    median_latency REAL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS team_accuracy (
+                    team_id INTEGER,
+                    seq INTEGER,
+                    match_id INTEGER,
+                    answers INTEGER,
+                    accuracy REAL,
+                    cumulative_accuracy REAL,
+                    PRIMARY KEY (team_id, seq))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message TEXT NOT NULL,
+                    segment TEXT NOT NULL DEFAULT 'all',
+                    segment_value TEXT,
+                    status TEXT DEFAULT 'running',
+                    cursor INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    total INTEGER DEFAULT 0,
+                    progress_chat_id INTEGER,
+                    progress_message_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # فهارس استهداف البث: كل شريحة تُقرأ بترتيب user_id بدءاً من المؤشر
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_lang ON users(lang, user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_team_team ON user_team(team_id, user_id)")
+    migrate_tournament_scope(c)
+    if not has_tournament_teams:
+        migrate_tournament_teams(c)
+    if not has_participants:
+        # المباريات السابقة: أعضاء الفريقين الحاليون، كما كان يقيّمهم update_match
+        c.execute('''
+            INSERT OR IGNORE INTO match_participants (match_id, user_id, team_id)
+            SELECT m.id, ut.user_id, ut.team_id FROM matches m
+            JOIN user_team ut ON ut.team_id IN (m.team1_id, m.team2_id)
+            WHERE m.status != 'pending'
+        ''')
+    if 'asked_at' not in _columns(c, 'match_questions'):
+        c.execute("ALTER TABLE match_questions ADD COLUMN asked_at TIMESTAMP")
+    if not has_history:
+        restore_archived_history(c)
+    # فهارس المباريات: كل استعلام ساخن مقيد بالبطولة، والتصفح بالمفتاح (keyset) على matches.id،
+    # أو على (scheduled_time, id) عند تحديد نافذة زمنية
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_tournament ON matches(tournament_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_t_phase ON matches(tournament_id, phase, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_t_status ON matches(tournament_id, status, id)")
+    c.execute("DROP INDEX IF EXISTS idx_matches_t_scheduled")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_t_scheduled_id ON matches(tournament_id, scheduled_time, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_scheduled ON matches(scheduled_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_team_stats_group ON team_stats(tournament_id, group_name)")
+    # الترحيلات محفوظة قبل backfill_ratings لأنها تقرأ السجل باتصال آخر، والإصدار بعدها كي تُعاد إن فشلت
+    conn.commit()
+    backfill_ratings(conn)
+    c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
     conn.close()
 
+def _columns(c: sqlite3.Cursor, table: str) -> List[str]:
+    return [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+
+def migrate_tournament_scope(c: sqlite3.Cursor):
+    """
+    ترحيل قاعدة بيانات من نسخة البطولة الواحدة: الصفوف القديمة تُنسب إلى بطولة
+    محادثة المالك الخاصة، حيث كانت أوامر المالك تُنفذ سابقاً.
+    """
+    c.execute("DROP INDEX IF EXISTS idx_matches_phase")
+    c.execute("DROP INDEX IF EXISTS idx_matches_status")
+    legacy_id = None
+    if 'tournament_id' not in _columns(c, 'matches'):
+        c.execute("ALTER TABLE matches ADD COLUMN tournament_id INTEGER")
+    for table, schema in (('team_stats', TEAM_STATS_SCHEMA), ('tournament', TOURNAMENT_SCHEMA)):
+        if 'tournament_id' in _columns(c, table):
+            continue
+        old_columns = ", ".join(_columns(c, table))
+        c.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        c.execute(schema.format(name=table))
+        c.execute(f"INSERT INTO {table} ({old_columns}) SELECT {old_columns} FROM {table}_legacy")
+        c.execute(f"DROP TABLE {table}_legacy")
+    for table in ('matches', 'team_stats', 'tournament'):
+        if c.execute(f"SELECT 1 FROM {table} WHERE tournament_id IS NULL LIMIT 1").fetchone():
+            if legacy_id is None:
+                c.execute("INSERT OR IGNORE INTO chat_groups (chat_id) VALUES (?)", (OWNER_ID,))
+                legacy_id = c.execute("SELECT id FROM chat_groups WHERE chat_id = ?", (OWNER_ID,)).fetchone()[0]
+            c.execute(f"UPDATE {table} SET tournament_id = ? WHERE tournament_id IS NULL", (legacy_id,))
+
+def migrate_tournament_teams(c: sqlite3.Cursor):
+    """
+    الفرق كانت مجمعاً واحداً لكل البطولات: كل بطولة قائمة تحتفظ بفرق team_stats الخاصة بها،
+    وبقية الفرق النشطة تُنسب إلى بطولة محادثة المالك كما في migrate_tournament_scope.
+    """
+    c.execute("INSERT OR IGNORE INTO tournament_teams (tournament_id, team_id) "
+              "SELECT DISTINCT tournament_id, team_id FROM team_stats")
+    if c.execute("SELECT 1 FROM teams WHERE active = 1 AND id NOT IN (SELECT team_id FROM tournament_teams) "
+                 "LIMIT 1").fetchone():
+        c.execute("INSERT OR IGNORE INTO chat_groups (chat_id) VALUES (?)", (OWNER_ID,))
+        legacy_id = c.execute("SELECT id FROM chat_groups WHERE chat_id = ?", (OWNER_ID,)).fetchone()[0]
+        c.execute("INSERT OR IGNORE INTO tournament_teams (tournament_id, team_id) "
+                  "SELECT ?, id FROM teams WHERE active = 1 AND id NOT IN (SELECT team_id FROM tournament_teams)",
+                  (legacy_id,))
+
 def db_execute(query: str, params: tuple = ()):
+    # للتحميل عند التشغيل وللقراءة من خيوط الحساب؛ كل كتابة بعد التشغيل تمر عبر database.run
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     c.execute(query, params)
@@ -122,45 +400,247 @@ def db_execute(query: str, params: tuple = ()):
     conn.close()
     return result
 
-def db_insert(query: str, params: tuple) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(query, params)
-    conn.commit()
-    last_id = c.lastrowid
-    conn.close()
-    return last_id
+# ------------------ واجهة قاعدة البيانات غير المتزامنة ------------------
+class AsyncDatabase:
+    """
+    تنفيذ استعلامات sqlite خارج حلقة الأحداث: كل الكتابات على خيط كاتب واحد باتصال دائم،
+    وجمل SELECT على مجموعة خيوط قراءة لكل منها اتصاله (وضع WAL يسمح بالقراءة أثناء الكتابة).
+    القراءات المتطابقة (الاستعلام والمعاملات) الجارية في نفس الوقت تتشارك نتيجة واحدة.
+    """
+
+    def __init__(self, readers: int = DB_READERS):
+        self.readers = readers
+        self._local = threading.local()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        # يزداد بعد كل كتابة كي لا تنضم قراءة جديدة إلى قراءة بدأت قبل الكتابة
+        self._generation = 0
+
+    def start(self, path: Optional[str] = None):
+        path = path or DB_PATH
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer",
+                                          initializer=self._open, initargs=(path, False))
+        self._reader_pool = ThreadPoolExecutor(self.readers, thread_name_prefix="db-reader",
+                                               initializer=self._open, initargs=(path, True))
+
+    def close(self):
+        for pool in (self._writer, self._reader_pool):
+            if pool:
+                pool.shutdown(wait=True)
+        self._writer = self._reader_pool = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def _open(self, path: str, read_only: bool):
+        if read_only:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False)
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+
+    # --- على خيوط قاعدة البيانات ---
+    def _read(self, query: str, params: tuple) -> list:
+        return self._local.conn.execute(query, params).fetchall()
+
+    def _write(self, fn: Callable, args: tuple):
+        conn = self._local.conn
+        with conn:
+            return fn(conn, *args)
+
+    # --- من حلقة الأحداث ---
+    async def run(self, fn: Callable, *args):
+        """تنفيذ fn(conn, *args) على خيط الكاتب داخل معاملة واحدة."""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._writer, self._write, fn, args)
+        finally:
+            self._generation += 1
+
+    async def execute(self, query: str, params: tuple = ()) -> list:
+        return await self.run(lambda conn: conn.execute(query, params).fetchall())
+
+    async def insert(self, query: str, params: tuple) -> int:
+        return await self.run(lambda conn: conn.execute(query, params).lastrowid)
+
+    async def executemany(self, query: str, seq_of_params: list):
+        await self.run(lambda conn: conn.executemany(query, seq_of_params))
+
+    async def fetch(self, query: str, params: tuple = ()) -> list:
+        key = (self._generation, query, params)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self._reader_pool, self._read, query, params)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _f: self._inflight.pop(key, None))
+        # shield: إلغاء أحد المنتظرين لا يلغي النتيجة المشتركة للآخرين
+        return list(await asyncio.shield(future))
+
+
+database = AsyncDatabase()
 
 # ------------------ دوال المساعدة العامة ------------------
 def is_owner(user_id: int) -> bool:
     return user_id == OWNER_ID
 
+# ------------------ فهرس الفرق والعضويات في الذاكرة ------------------
+class TeamIndex:
+    """
+    نسخة في الذاكرة من جداول teams و user_team و tournament_teams حتى تصبح عمليات البحث
+    قراءة من قاموس.
+    """
+
+    def __init__(self):
+        self.id_by_name: Dict[str, int] = {}
+        self.name_by_id: Dict[int, str] = {}
+        self.active: Dict[int, bool] = {}
+        self.team_by_user: Dict[int, int] = {}
+        self.players_by_team: Dict[int, List[int]] = {}
+        self.teams_by_tournament: Dict[int, List[int]] = {}
+
+    def load(self, teams: Optional[list] = None, members: Optional[list] = None, entries: Optional[list] = None):
+        """
+        تحميل الفهرس كاملاً (مرة واحدة عند التشغيل). يمكن تمرير الصفوف مقروءة مسبقاً
+        (كما في warm_caches)؛ members بترتيب joined_at و entries بترتيب الإضافة.
+        """
+        self.__init__()
+        if teams is None:
+            teams = db_execute("SELECT id, name, active FROM teams")
+        if members is None:
+            members = db_execute("SELECT user_id, team_id FROM user_team ORDER BY joined_at")
+        if entries is None:
+            entries = db_execute("SELECT tournament_id, team_id FROM tournament_teams ORDER BY rowid")
+        for team_id, name, active in teams:
+            self.add_team(team_id, name, bool(active))
+        for user_id, team_id in members:
+            if team_id in self.name_by_id and user_id not in self.team_by_user:
+                self.add_member(user_id, team_id)
+        for tournament_id, team_id in entries:
+            if team_id in self.name_by_id:
+                self.enter(tournament_id, team_id)
+
+    def add_team(self, team_id: int, name: str, active: bool = True):
+        self.id_by_name[name] = team_id
+        self.name_by_id[team_id] = name
+        self.active[team_id] = active
+        self.players_by_team.setdefault(team_id, [])
+
+    def remove_team(self, team_id: int):
+        name = self.name_by_id.pop(team_id, None)
+        if name is not None:
+            self.id_by_name.pop(name, None)
+        self.active.pop(team_id, None)
+        for user_id in self.players_by_team.pop(team_id, []):
+            self.team_by_user.pop(user_id, None)
+        for tournament_id in self.tournaments_of(team_id):
+            self.withdraw(tournament_id, team_id)
+
+    def enter(self, tournament_id: int, team_id: int):
+        teams = self.teams_by_tournament.setdefault(tournament_id, [])
+        if team_id not in teams:
+            teams.append(team_id)
+
+    def withdraw(self, tournament_id: int, team_id: int):
+        teams = self.teams_by_tournament.get(tournament_id, [])
+        if team_id in teams:
+            teams.remove(team_id)
+
+    def tournaments_of(self, team_id: int) -> List[int]:
+        return [tid for tid, teams in self.teams_by_tournament.items() if team_id in teams]
+
+    def add_member(self, user_id: int, team_id: int):
+        self.team_by_user[user_id] = team_id
+        self.players_by_team.setdefault(team_id, []).append(user_id)
+
+    def remove_member(self, user_id: int):
+        team_id = self.team_by_user.pop(user_id, None)
+        if team_id is not None:
+            players = self.players_by_team.get(team_id, [])
+            if user_id in players:
+                players.remove(user_id)
+
+    def active_teams(self, tournament_id: Optional[int] = None) -> List[Tuple[int, str]]:
+        """الفرق النشطة في بطولة بعينها، أو في كل البطولات إن لم تُحدد."""
+        if tournament_id is None:
+            return [(tid, name) for tid, name in self.name_by_id.items() if self.active[tid]]
+        return [(tid, self.name_by_id[tid]) for tid in self.teams_by_tournament.get(tournament_id, [])
+                if self.active[tid]]
+
+
+team_index = TeamIndex()
+
 def get_team_id(name: str) -> Optional[int]:
-    res = db_execute("SELECT id FROM teams WHERE name = ?", (name,))
-    return res[0][0] if res else None
+    return team_index.id_by_name.get(name)
 
 def get_team_name(team_id: int) -> Optional[str]:
-    res = db_execute("SELECT name FROM teams WHERE id = ?", (team_id,))
-    return res[0][0] if res else None
+    return team_index.name_by_id.get(team_id)
 
 def list_teams() -> List[str]:
-    res = db_execute("SELECT name FROM teams WHERE active=1 ORDER BY name")
-    return [row[0] for row in res]
+    return sorted(name for _tid, name in team_index.active_teams())
 
 def get_team_players(team_id: int) -> List[int]:
-    res = db_execute("SELECT user_id FROM user_team WHERE team_id = ?", (team_id,))
-    return [row[0] for row in res]
+    return list(team_index.players_by_team.get(team_id, []))
 
 def get_user_team(user_id: int) -> Optional[int]:
-    res = db_execute("SELECT team_id FROM user_team WHERE user_id = ?", (user_id,))
+    return team_index.team_by_user.get(user_id)
+
+# رقم البطولة لكل محادثة؛ لا يتغير بعد إنشائه
+tournament_ids: Dict[int, int] = {}
+
+async def get_tournament_id(chat_id: int) -> int:
+    """رقم بطولة المحادثة، يُنشأ صف chat_groups عند أول استخدام."""
+    tid = tournament_ids.get(chat_id)
+    if tid is None:
+        def create(conn):
+            conn.execute("INSERT OR IGNORE INTO chat_groups (chat_id) VALUES (?)", (chat_id,))
+            return conn.execute("SELECT id FROM chat_groups WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        tid = await database.run(create)
+        tournament_ids[chat_id] = tid
+    return tid
+
+async def get_phase(tournament_id: int) -> Optional[str]:
+    res = await database.fetch("SELECT value FROM tournament WHERE tournament_id = ? AND key = 'phase'", (tournament_id,))
     return res[0][0] if res else None
 
+# لغة كل مستخدم في الذاكرة، لأن _() تُستدعى بشكل متزامن في كل رد
+# لغة المستخدمين الذين اختاروا غير DEFAULT_LANG فقط؛ الغائب يعني اللغة الافتراضية
+user_langs: Dict[int, str] = {}
+
+def warm_caches():
+    """تعبئة فهرس الفرق والعضويات ولغات المستخدمين بقراءة واحدة بدل استعلام لكل جدول."""
+    rows = db_execute('''
+        SELECT 0, id, name, active FROM teams
+        UNION ALL
+        SELECT 1, user_id, team_id, joined_at FROM user_team
+        UNION ALL
+        SELECT 2, tournament_id, team_id, rowid FROM tournament_teams
+        UNION ALL
+        SELECT 3, user_id, lang, NULL FROM users WHERE lang != ?
+    ''', (DEFAULT_LANG,))
+    # الأجزاء تأتي متتالية عادةً فيكون الفرز مروراً واحداً؛ ثم تُقطع بالبحث الثنائي
+    rows.sort(key=itemgetter(0))
+    members_at, entries_at, users_at = (bisect_left(rows, (kind,)) for kind in (1, 2, 3))
+    members = sorted(rows[members_at:entries_at], key=lambda m: m[3] or "")
+    entries = sorted(rows[entries_at:users_at], key=itemgetter(3))
+    team_index.load(list(map(itemgetter(1, 2, 3), rows[:members_at])), list(map(itemgetter(1, 2), members)),
+                    list(map(itemgetter(1, 2), entries)))
+    user_langs.clear()
+    user_langs.update(map(itemgetter(1, 2), rows[users_at:]))
+
 def get_user_lang(user_id: int) -> str:
-    res = db_execute("SELECT lang FROM users WHERE user_id = ?", (user_id,))
-    return res[0][0] if res else DEFAULT_LANG
+    return user_langs.get(user_id, DEFAULT_LANG)
 
-def set_user_lang(user_id: int, lang: str):
-    db_execute("UPDATE users SET lang = ? WHERE user_id = ?", (lang, user_id))
+async def set_user_lang(user_id: int, lang: str):
+    await database.execute("UPDATE users SET lang = ? WHERE user_id = ?", (lang, user_id))
+    user_langs[user_id] = lang
 
 # ------------------ دوال الترجمة ------------------
 translations = {
@@ -210,6 +690,8 @@ def fetch_questions(amount: int = 25, difficulty_boost: float = 1.0) -> List[Dic
     """
     جلب أسئلة بمستويات صعوبة مختلفة. difficulty_boost يزيد من نسبة الأسئلة الصعبة.
     """
+    import requests
+
     # نحدد عدد الأسئلة حسب المستوى
     if difficulty_boost > 1.5:
         easy, medium, hard = 5, 8, 12
@@ -224,6 +706,8 @@ def fetch_questions(amount: int = 25, difficulty_boost: float = 1.0) -> List[Dic
         easy = int(easy * factor)
         medium = int(medium * factor)
         hard = amount - easy - medium
+    # تعديل المزيج حسب نسب النجاح المرصودة بدل تسميات opentdb
+    easy, medium, hard = calibrated_mix(easy, medium, hard)
     difficulties = [('easy', easy), ('medium', medium), ('hard', hard)]
     questions = []
     for diff, cnt in difficulties:
@@ -244,9 +728,9 @@ def fetch_questions(amount: int = 25, difficulty_boost: float = 1.0) -> List[Dic
                         'difficulty': diff
                     })
             else:
-                logger.error(f"فشل جلب الأسئلة الصعوبة {diff}: {data['response_code']}")
+                logger.error("فشل جلب الأسئلة الصعوبة %s: %s", diff, data['response_code'])
         except Exception as e:
-            logger.exception(f"خطأ في جلب الأسئلة {diff}: {e}")
+            logger.exception("خطأ في جلب الأسئلة %s: %s", diff, e)
     # إذا لم نتمكن من جلب الكمية، نكمل بأسئلة افتراضية
     while len(questions) < amount:
         questions.append({
@@ -258,11 +742,567 @@ def fetch_questions(amount: int = 25, difficulty_boost: float = 1.0) -> List[Dic
     random.shuffle(questions)
     return questions[:amount]
 
+# ------------------ معايرة صعوبة الأسئلة ------------------
+# نسبة النجاح المرصودة لكل تسمية صعوبة، من جدول difficulty_calibration
+difficulty_success: Dict[str, float] = {}
+
+def load_calibration():
+    difficulty_success.clear()
+    for difficulty, rate in db_execute("SELECT difficulty, success_rate FROM difficulty_calibration WHERE answers >= ?",
+                                       (CALIBRATION_MIN_ANSWERS,)):
+        difficulty_success[difficulty] = rate
+
+def calibrated_mix(easy: int, medium: int, hard: int) -> Tuple[int, int, int]:
+    """
+    الهدف هو عدد الإجابات الصحيحة المتوقع لمزيج المستوى بالنسب الاسمية؛ ننقل سؤالاً واحداً
+    بين التسميات في كل خطوة ما دام ذلك يقرّب التوقع بالنسب المرصودة من الهدف.
+    """
+    counts = {'easy': easy, 'medium': medium, 'hard': hard}
+    target = sum(NOMINAL_SUCCESS[d] * n for d, n in counts.items())
+    rates = {d: difficulty_success.get(d, NOMINAL_SUCCESS[d]) for d in counts}
+
+    def error(c):
+        return abs(sum(rates[d] * n for d, n in c.items()) - target)
+
+    best_error = error(counts)
+    while True:
+        best = None
+        for src in counts:
+            if counts[src] == 0:
+                continue
+            for dst in counts:
+                if dst == src:
+                    continue
+                trial = dict(counts, **{src: counts[src] - 1, dst: counts[dst] + 1})
+                e = error(trial)
+                if e < best_error - 1e-9:
+                    best, best_error = trial, e
+        if best is None:
+            return counts['easy'], counts['medium'], counts['hard']
+        counts = best
+
+def _group_median(groups, values, n_groups: int, weights=None):
+    """
+    وسيط values لكل مجموعة (رقمها 0..n_groups-1) بفرز واحد، مع تجاهل NaN.
+    weights عدد مرات كل قيمة (1 افتراضاً)، لدمج مدرج latency_totals مع القيم الحية.
+    """
+    import numpy as np
+
+    if weights is None:
+        weights = np.ones(len(values))
+    ok = ~np.isnan(values)
+    groups, values, weights = groups[ok], values[ok], weights[ok]
+    totals = np.bincount(groups, weights=weights, minlength=n_groups)
+    order = np.lexsort((values, groups))
+    values, weights = values[order], weights[order]
+    cum = np.cumsum(weights)
+    # منتصف كل مجموعة على المجموع التراكمي: أول قيمة تبلغه وأول قيمة تتجاوزه
+    half = np.cumsum(totals) - totals / 2
+    median = np.full(n_groups, np.nan)
+    has = totals > 0
+    lo = np.searchsorted(cum, half[has], side='left')
+    hi = np.searchsorted(cum, half[has], side='right')
+    median[has] = (values[lo] + values[hi]) / 2
+    return median
+
+def compute_question_analytics(chunk_size: int = ANALYTICS_CHUNK) -> Dict:
+    """
+    تحميل سجل الإجابات على دفعات إلى مصفوفات NumPy وحساب نسبة النجاح ووسيط زمن الإجابة
+    (answered_at - asked_at) لكل سؤال ولكل تسمية صعوبة، ومنحنى دقة كل فريق عبر مبارياته بالترتيب.
+    البطولات المؤرشفة تدخل من ملخصاتها (question_totals و latency_totals و team_match_totals).
+    تعيد صفوفاً جاهزة لـ store_calibration.
+    """
+    import numpy as np
+
+    labels = list(NOMINAL_SUCCESS)
+    question_codes: Dict[str, int] = {}
+    columns = ('match', 'team', 'correct', 'label', 'question', 'latency')
+    chunks: Dict[str, list] = {key: [] for key in columns}
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        archived_questions = conn.execute("SELECT question_text, difficulty, answers, correct FROM question_totals").fetchall()
+        archived_latency = conn.execute("SELECT question_text, difficulty, seconds, answers FROM latency_totals").fetchall()
+        archived_teams = conn.execute("SELECT team_id, match_id, answers, correct FROM team_match_totals").fetchall()
+        last_rowid = 0
+        while True:
+            rows = conn.execute('''
+                SELECT pa.rowid, pa.match_id, COALESCE(mp.team_id, -1), pa.is_correct,
+                       CASE mq.difficulty WHEN 'easy' THEN 0 WHEN 'medium' THEN 1 WHEN 'hard' THEN 2 ELSE -1 END,
+                       mq.question_text,
+                       (julianday(pa.answered_at) - julianday(mq.asked_at)) * 86400.0
+                FROM player_answers pa
+                JOIN match_questions mq ON mq.match_id = pa.match_id AND mq.question_index = pa.question_index
+                LEFT JOIN match_participants mp ON mp.match_id = pa.match_id AND mp.user_id = pa.user_id
+                WHERE pa.rowid > ? ORDER BY pa.rowid LIMIT ?
+            ''', (last_rowid, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            _rowid, match, team, correct, label, text, latency = zip(*rows)
+            chunks['match'].append(np.array(match, dtype=np.int64))
+            chunks['team'].append(np.array(team, dtype=np.int64))
+            chunks['correct'].append(np.array(correct, dtype=np.float64))
+            chunks['label'].append(np.array(label, dtype=np.int64))
+            chunks['question'].append(np.array([question_codes.setdefault(t, len(question_codes)) for t in text],
+                                               dtype=np.int64))
+            chunks['latency'].append(np.array(latency, dtype=np.float64))  # None => NaN
+    finally:
+        conn.close()
+    result = {'answers': 0, 'questions': [], 'difficulties': [], 'teams': []}
+    if not question_codes and not archived_questions:
+        return result
+    dtypes = {'correct': np.float64, 'latency': np.float64}
+    match, team, correct, label, question, latency = (
+        np.concatenate(chunks[key]) if chunks[key] else np.empty(0, dtype=dtypes.get(key, np.int64))
+        for key in columns)
+    # الملخصات المؤرشفة: أسئلتها تُرقَّم بعد الأسئلة الحية
+    a_question = np.array([question_codes.setdefault(t, len(question_codes)) for t, _d, _n, _c in archived_questions],
+                          dtype=np.int64)
+    a_label = np.array([labels.index(d) if d in labels else -1 for _t, d, _n, _c in archived_questions], dtype=np.int64)
+    a_asked = np.array([n for _t, _d, n, _c in archived_questions], dtype=np.int64)
+    a_right = np.array([c for _t, _d, _n, c in archived_questions], dtype=np.float64)
+    l_question = np.array([question_codes.setdefault(t, len(question_codes)) for t, _d, _s, _n in archived_latency],
+                          dtype=np.int64)
+    l_label = np.array([labels.index(d) if d in labels else -1 for _t, d, _s, _n in archived_latency], dtype=np.int64)
+    l_seconds = np.array([sec for _t, _d, sec, _n in archived_latency], dtype=np.float64)
+    l_count = np.array([n for _t, _d, _s, n in archived_latency], dtype=np.float64)
+    result['answers'] = len(correct) + int(a_asked.sum())
+
+    # لكل سؤال
+    n_q = len(question_codes)
+    asked = np.bincount(question, minlength=n_q) + np.bincount(a_question, weights=a_asked, minlength=n_q).astype(np.int64)
+    right = np.bincount(question, weights=correct, minlength=n_q) + np.bincount(a_question, weights=a_right, minlength=n_q)
+    q_median = _group_median(np.r_[question, l_question], np.r_[latency, l_seconds], n_q,
+                             np.r_[np.ones(len(latency)), l_count])
+    q_label = np.full(n_q, -1, dtype=np.int64)
+    q_label[a_question] = a_label
+    q_label[question] = label
+    q_median = np.where(np.isnan(q_median), None, q_median)
+    result['questions'] = list(zip(question_codes, [labels[i] if i >= 0 else None for i in q_label.tolist()],
+                                   asked.tolist(), (right / asked).tolist(), q_median.tolist()))
+
+    # لكل تسمية صعوبة
+    known, a_known = label >= 0, a_label >= 0
+    d_asked = (np.bincount(label[known], minlength=len(labels))
+               + np.bincount(a_label[a_known], weights=a_asked[a_known], minlength=len(labels)).astype(np.int64))
+    d_right = (np.bincount(label[known], weights=correct[known], minlength=len(labels))
+               + np.bincount(a_label[a_known], weights=a_right[a_known], minlength=len(labels)))
+    l_known = l_label >= 0
+    d_median = _group_median(np.r_[label[known], l_label[l_known]], np.r_[latency[known], l_seconds[l_known]],
+                             len(labels), np.r_[np.ones(int(known.sum())), l_count[l_known]])
+    result['difficulties'] = [
+        (labels[i], int(d_asked[i]), float(d_right[i] / d_asked[i]),
+         None if np.isnan(d_median[i]) else float(d_median[i]))
+        for i in range(len(labels)) if d_asked[i]]
+
+    # منحنى دقة كل فريق: دقة كل مباراة والدقة التراكمية حتى نهايتها. فريق كل إجابة هو فريق
+    # اللاعب في تلك المباراة (match_participants)، و -1 لمن ليس في تشكيلتها
+    in_team = team >= 0
+    g_team, g_match = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    g_n, g_right = np.empty(0, dtype=np.int64), np.empty(0)
+    if in_team.any():
+        t, m, c = team[in_team], match[in_team], correct[in_team]
+        order = np.lexsort((m, t))
+        t, m, c = t[order], m[order], c[order]
+        starts = np.flatnonzero(np.r_[True, (t[1:] != t[:-1]) | (m[1:] != m[:-1])])
+        g_team, g_match = t[starts], m[starts]
+        g_n = np.diff(np.r_[starts, len(t)])
+        g_right = np.add.reduceat(c, starts)
+    if archived_teams:
+        # مباريات البطولات المؤرشفة لم تعد في player_answers فلا تتكرر مع الحية
+        g_team = np.r_[g_team, np.array([r[0] for r in archived_teams], dtype=np.int64)]
+        g_match = np.r_[g_match, np.array([r[1] for r in archived_teams], dtype=np.int64)]
+        g_n = np.r_[g_n, np.array([r[2] for r in archived_teams], dtype=np.int64)]
+        g_right = np.r_[g_right, np.array([r[3] for r in archived_teams], dtype=np.float64)]
+        order = np.lexsort((g_match, g_team))
+        g_team, g_match, g_n, g_right = g_team[order], g_match[order], g_n[order], g_right[order]
+    if len(g_team):
+        cum_n, cum_right = np.cumsum(g_n), np.cumsum(g_right)
+        team_first = np.flatnonzero(np.r_[True, g_team[1:] != g_team[:-1]])
+        first_of = np.repeat(team_first, np.diff(np.r_[team_first, len(g_team)]))
+        base_n = np.where(first_of > 0, cum_n[first_of - 1], 0)
+        base_right = np.where(first_of > 0, cum_right[first_of - 1], 0.0)
+        seq = np.arange(len(g_team)) - first_of
+        result['teams'] = list(zip(g_team.tolist(), seq.tolist(), g_match.tolist(), g_n.tolist(),
+                                   (g_right / g_n).tolist(),
+                                   ((cum_right - base_right) / (cum_n - base_n)).tolist()))
+    return result
+
+def store_calibration(conn: sqlite3.Connection, result: Dict):
+    """على خيط الكاتب: استبدال جداول المعايرة بنتيجة compute_question_analytics."""
+    for table in ('question_calibration', 'difficulty_calibration', 'team_accuracy'):
+        conn.execute(f"DELETE FROM {table}")
+    conn.executemany("INSERT INTO question_calibration (question_text, difficulty, answers, success_rate, median_latency) "
+                     "VALUES (?, ?, ?, ?, ?)", result['questions'])
+    conn.executemany("INSERT INTO difficulty_calibration (difficulty, answers, success_rate, median_latency) "
+                     "VALUES (?, ?, ?, ?)", result['difficulties'])
+    conn.executemany("INSERT INTO team_accuracy (team_id, seq, match_id, answers, accuracy, cumulative_accuracy) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", result['teams'])
+
+async def run_calibration() -> Dict:
+    await answer_journal.flush()
+    result = await asyncio.to_thread(compute_question_analytics)
+    await database.run(store_calibration, result)
+    difficulty_success.clear()
+    difficulty_success.update({d: rate for d, n, rate, _lat in result['difficulties'] if n >= CALIBRATION_MIN_ANSWERS})
+    logger.info("معايرة الأسئلة: %d إجابة، %d سؤال", result['answers'], len(result['questions']))
+    return result
+
+# ------------------ تصنيف الفرق واللاعبين (Elo) ------------------
+def elo_expected(rating: float, opponent: float) -> float:
+    return 1.0 / (1.0 + 10 ** ((opponent - rating) / RATING_SCALE))
+
+class RatingBook:
+    """
+    تصنيف Elo لكل فريق ('team') ولكل لاعب ('player')، محفوظ في جدول ratings ومخزن في الذاكرة.
+    اللاعب يُقيَّم بنتيجة فريقه أمام تصنيف الفريق المنافس. lock يمنع تحديث مباراة
+    أثناء إعادة الحساب الكاملة (rerate) كي لا يضيع أحدهما.
+    """
+
+    def __init__(self):
+        self.ratings: Dict[Tuple[str, int], float] = {}
+        self.games: Dict[Tuple[str, int], int] = {}
+        self.lock = asyncio.Lock()
+
+    def load(self):
+        rows = db_execute("SELECT kind, entity_id, rating, games FROM ratings")
+        self.replace({(kind, entity_id): rating for kind, entity_id, rating, _g in rows},
+                     {(kind, entity_id): games for kind, entity_id, _r, games in rows})
+
+    def replace(self, ratings: Dict[Tuple[str, int], float], games: Dict[Tuple[str, int], int]):
+        # استبدال القواميس دفعة واحدة كي لا يرى القارئ حالة نصف محمّلة
+        self.ratings, self.games = ratings, games
+
+    def get(self, kind: str, entity_id: int) -> float:
+        return self.ratings.get((kind, entity_id), RATING_BASE)
+
+    def update_match(self, team1_id: int, team2_id: int, score1: float,
+                     team1_players: List[int], team2_players: List[int]) -> List[tuple]:
+        """
+        تحديث تدريجي في الذاكرة بعد مباراة واحدة؛ score1 = 1 فوز، 0.5 تعادل، 0 خسارة للفريق الأول.
+        اللاعبون هم تشكيلة match_participants. تعيد صفوف ratings المتغيرة ليحفظها المستدعي
+        مع نتيجة المباراة في معاملة واحدة (save_match_result).
+        """
+        r1, r2 = self.get('team', team1_id), self.get('team', team2_id)
+        changed = {
+            ('team', team1_id): r1 + RATING_K * (score1 - elo_expected(r1, r2)),
+            ('team', team2_id): r2 + RATING_K * ((1 - score1) - elo_expected(r2, r1)),
+        }
+        for players, score, opponent in ((team1_players, score1, r2), (team2_players, 1 - score1, r1)):
+            for uid in players:
+                rp = self.get('player', uid)
+                changed[('player', uid)] = rp + RATING_K * (score - elo_expected(rp, opponent))
+        rows = []
+        for key, rating in changed.items():
+            self.ratings[key] = rating
+            self.games[key] = self.games.get(key, 0) + 1
+            rows.append((key[0], key[1], rating, self.games[key]))
+        return rows
+
+
+rating_book = RatingBook()
+
+def rating_difficulty_boost(rating1: float, rating2: float) -> float:
+    """
+    معامل الصعوبة لـ fetch_questions من فرق تصنيف الفريقين: كلما تقارب الفريقان زادت الأسئلة
+    الصعبة لأنها ما يفصل بينهما، وكلما اتسع الفرق مال المزيج إلى السهل كي يسجل الأضعف.
+    فريقان متساويان => 2.0 (أصعب مزيج)، فرق ~100 => ~1.4، فرق 200 فأكثر => 1.0 أو أقل.
+    """
+    expected = elo_expected(rating1, rating2)
+    return 2.0 * (1.0 - abs(2.0 * expected - 1.0))
+
+def match_history() -> List[Tuple[int, int, int, float]]:
+    """
+    المباريات المنتهية بالترتيب: (رقم المباراة، الفريق الأول، الفريق الثاني، نتيجة الأول)،
+    ومعها مباريات البطولات المؤرشفة من match_results.
+    """
+    rows = db_execute('''
+        SELECT id, team1_id, team2_id, winner_id FROM matches WHERE played = 1
+        UNION ALL
+        SELECT match_id, team1_id, team2_id, winner_id FROM match_results
+        ORDER BY 1
+    ''')
+    return [(mid, t1, t2, 0.5 if winner is None else float(winner == t1)) for mid, t1, t2, winner in rows]
+
+def recompute_ratings(history: Optional[List[Tuple[int, int, int, float]]] = None,
+                      k: float = RATING_K) -> Tuple[Dict[Tuple[str, int], float], Dict[Tuple[str, int], int]]:
+    """
+    إعادة حساب كل التصنيفات وعدد المباريات من سجل المباريات دفعة واحدة باستخدام NumPy، دون حفظ.
+    المباريات تُقسَّم إلى موجات لا يتكرر فيها فريق ولا لاعب، فتُحدَّث كل موجة بعمليات متجهية
+    مع الحفاظ على نتيجة التحديث التتابعي. مرّر history مختلفاً لتجربة "ماذا لو".
+    """
+    if history is None:
+        history = match_history()
+    if not history:
+        return {}, {}
+    import numpy as np
+
+    match_ids = np.array([h[0] for h in history], dtype=np.int64)
+    team_ids, team_idx = np.unique(np.array([(h[1], h[2]) for h in history], dtype=np.int64), return_inverse=True)
+    team_idx = team_idx.reshape(-1, 2)
+    score1 = np.array([h[3] for h in history], dtype=np.float64)
+
+    # المشاركون: تشكيلة كل فريق عند بدء المباراة، كما في update_match
+    participants = db_execute("SELECT match_id, user_id, team_id FROM match_participants ORDER BY match_id")
+    row_of_match = {mid: i for i, mid in enumerate(match_ids.tolist())}
+    players_of = [[] for _ in history]
+    p_match, p_user, p_side = [], [], []
+    for mid, uid, team in participants:
+        i = row_of_match.get(mid)
+        if i is None:
+            continue
+        if team == history[i][1]:
+            side = 0
+        elif team == history[i][2]:
+            side = 1
+        else:
+            continue
+        players_of[i].append(uid)
+        p_match.append(i)
+        p_user.append(uid)
+        p_side.append(side)
+    p_match = np.array(p_match, dtype=np.int64)
+    p_side = np.array(p_side, dtype=np.int64)
+    user_ids, p_idx = np.unique(np.array(p_user, dtype=np.int64), return_inverse=True)
+
+    # موجة كل مباراة = بعد آخر موجة ظهر فيها أي من الفريقين أو أي من لاعبيها؛ اللاعب قد
+    # يظهر مع فريقين مختلفين بعد تغيير فريقه، ولا يصح أن يُحدَّث مرتين في موجة واحدة
+    wave = np.empty(len(history), dtype=np.int64)
+    last_wave = np.full(len(team_ids), -1, dtype=np.int64)
+    player_wave: Dict[int, int] = {}
+    for i, (a, b) in enumerate(team_idx):
+        w = max(last_wave[a], last_wave[b], *(player_wave.get(uid, -1) for uid in players_of[i])) + 1
+        wave[i] = last_wave[a] = last_wave[b] = w
+        for uid in players_of[i]:
+            player_wave[uid] = w
+
+    team_r = np.full(len(team_ids), RATING_BASE)
+    team_g = np.zeros(len(team_ids), dtype=np.int64)
+    player_r = np.full(len(user_ids), RATING_BASE)
+    player_g = np.zeros(len(user_ids), dtype=np.int64)
+    p_wave = wave[p_match] if len(p_match) else p_match
+    for w in range(int(wave.max()) + 1):
+        rows = np.nonzero(wave == w)[0]
+        a, b = team_idx[rows, 0], team_idx[rows, 1]
+        ra, rb = team_r[a], team_r[b]
+        ea = 1.0 / (1.0 + 10 ** ((rb - ra) / RATING_SCALE))
+        s = score1[rows]
+        # اللاعبون يُحدَّثون أمام تصنيف المنافس قبل تحديث الموجة
+        prow = np.nonzero(p_wave == w)[0]
+        if len(prow):
+            pm, pu, ps = p_match[prow], p_idx[prow], p_side[prow]
+            opp = np.where(ps == 0, team_r[team_idx[pm, 1]], team_r[team_idx[pm, 0]])
+            ps_score = np.where(ps == 0, score1[pm], 1.0 - score1[pm])
+            rp = player_r[pu]
+            player_r[pu] = rp + k * (ps_score - 1.0 / (1.0 + 10 ** ((opp - rp) / RATING_SCALE)))
+            player_g[pu] += 1
+        team_r[a] = ra + k * (s - ea)
+        team_r[b] = rb + k * ((1.0 - s) - (1.0 - ea))
+        team_g[a] += 1
+        team_g[b] += 1
+
+    ratings = {('team', int(t)): float(r) for t, r in zip(team_ids, team_r)}
+    ratings.update({('player', int(u)): float(r) for u, r in zip(user_ids, player_r)})
+    games = {('team', int(t)): int(g) for t, g in zip(team_ids, team_g)}
+    games.update({('player', int(u)): int(g) for u, g in zip(user_ids, player_g)})
+    return ratings, games
+
+def replace_ratings(conn: sqlite3.Connection, rows: List[tuple]):
+    """على خيط الكاتب: استبدال جدول ratings كاملاً."""
+    conn.execute("DELETE FROM ratings")
+    conn.executemany("INSERT INTO ratings (kind, entity_id, rating, games) VALUES (?, ?, ?, ?)", rows)
+
+def backfill_ratings(conn: sqlite3.Connection):
+    """
+    ترحيل: قاعدة مرقّاة فيها مباريات منتهية وجدول ratings فارغ تُحسب تصنيفاتها من السجل،
+    وإلا قرأت كل الفرق RATING_BASE وحصلت على أصعب مزيج حتى يُشغَّل /rerate يدوياً.
+    """
+    if conn.execute("SELECT 1 FROM ratings LIMIT 1").fetchone():
+        return
+    ratings, games = recompute_ratings()
+    if ratings:
+        replace_ratings(conn, [(kind, entity_id, rating, games[(kind, entity_id)])
+                               for (kind, entity_id), rating in ratings.items()])
+        logger.info("حُسبت تصنيفات %d فريق ولاعب من سجل المباريات", len(ratings))
+
+async def rerate() -> Dict[Tuple[str, int], float]:
+    """إعادة حساب كل التصنيفات وحفظها؛ تحت rating_book.lock كي لا تُنهى مباراة في أثنائها."""
+    async with rating_book.lock:
+        ratings, games = await asyncio.to_thread(recompute_ratings)
+        await database.run(replace_ratings, [(kind, entity_id, rating, games[(kind, entity_id)])
+                                             for (kind, entity_id), rating in ratings.items()])
+        rating_book.replace(ratings, games)
+    return ratings
+
+# ------------------ سجل الإجابات (كتابة مؤجلة بدفعات) ------------------
+class AnswerJournal:
+    """
+    يجمع الإجابات في الذاكرة ويكتبها إلى player_answers و match_questions
+    بمعاملة واحدة كل JOURNAL_FLUSH_INTERVAL ثانية أو كل JOURNAL_MAX_BATCH إجابة.
+    كل إجابة تُلحق أيضاً بملف JOURNAL_PATH ولا يعود record() (ولا يُرد على اللاعب)
+    إلا بعد fsync للملف؛ الإجابات التي تصل أثناء fsync جارٍ تنتظر fsync واحداً مشتركاً
+    (group commit). يُفرَّغ الملف فقط حين تُحفظ كل الإجابات في القاعدة، فإن توقفت العملية
+    أو انقطع التيار قبل ذلك يعيد replay() تطبيقها عند التشغيل (الإعادة لا تكرر شيئاً).
+    الدفعات تُكتب على خيط الكاتب في database فلا تنتظر حلقة الأحداث القرص.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH, interval: float = JOURNAL_FLUSH_INTERVAL,
+                 max_batch: int = JOURNAL_MAX_BATCH):
+        self.path = path
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending: List[tuple] = []
+        self._file = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+        self._sync_waiters: List[asyncio.Future] = []
+        self._syncing: Optional[asyncio.Task] = None
+
+    def replay(self) -> int:
+        """إعادة تطبيق الإجابات المتبقية في الملف من تشغيل سابق. تُستدعى قبل open()."""
+        if not os.path.exists(self.path):
+            return 0
+        records = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(tuple(json.loads(line)))
+                except ValueError:
+                    # سطر أخير مبتور بسبب توقف مفاجئ؛ لم يُرسل رده للاعب
+                    break
+        if records:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                with conn:
+                    self._write_batch(conn, records)
+            finally:
+                conn.close()
+        os.remove(self.path)
+        return len(records)
+
+    def open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    async def record(self, match_id: int, user_id: int, q_index: int, answer: str, is_correct: bool):
+        answered_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        rec = (match_id, user_id, q_index, answer, int(is_correct), answered_at)
+        self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.pending.append(rec)
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._start_flush)
+        await self._sync()
+
+    async def _sync(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._sync_waiters.append(waiter)
+        if self._syncing is None or self._syncing.done():
+            self._syncing = asyncio.create_task(self._sync_loop())
+        await waiter
+
+    async def _sync_loop(self):
+        """fsync واحد لكل من ينتظر؛ من يصل أثناءه ينتظر الجولة التالية."""
+        while self._sync_waiters:
+            waiters, self._sync_waiters = self._sync_waiters, []
+            try:
+                await asyncio.to_thread(os.fsync, self._file.fileno())
+            except OSError as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    async def flush(self):
+        """ضمان أن كل الإجابات المسجلة حتى الآن محفوظة في قاعدة البيانات."""
+        while True:
+            self._start_flush()
+            task = self._flushing
+            if task is None or (task.done() and not self.pending):
+                return
+            await task
+
+    async def close(self):
+        await self.flush()
+        if self._syncing is not None:
+            await self._syncing
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.pending and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.create_task(self._drain())
+            self._flushing.add_done_callback(self._drain_done)
+
+    async def _drain(self):
+        while self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                await database.run(self._write_batch, batch)
+            except sqlite3.Error:
+                self.pending = batch + self.pending
+                raise
+        # كل ما في الملف محفوظ الآن في القاعدة؛ لا نعيد كتابة الملف وفيه إجابات معلقة
+        # كي لا تضيع إجابة سبق الرد عليها بين الاقتطاع و fsync التالي
+        self._file.seek(0)
+        self._file.truncate()
+
+    def _drain_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error("فشل حفظ دفعة الإجابات، ستُعاد المحاولة", exc_info=task.exception())
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._start_flush)
+
+    @staticmethod
+    def _write_batch(conn: sqlite3.Connection, records: List[tuple]):
+        conn.executemany('''
+            INSERT OR IGNORE INTO player_answers (match_id, user_id, question_index, answer, is_correct, answered_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', records)
+        conn.executemany(
+            "UPDATE match_questions SET answered=1, answered_by=? WHERE match_id=? AND question_index=? AND answered=0",
+            [(r[1], r[0], r[2]) for r in records])
+
+
+answer_journal = AnswerJournal()
+
 # ------------------ دوال المباريات ------------------
+def store_match_start(conn: sqlite3.Connection, match_id: int, questions: List[Dict],
+                      team1_id: int, team1_players: List[int], team2_id: int, team2_players: List[int]):
+    """على خيط الكاتب: أسئلة المباراة وتشكيلة الفريقين في معاملة واحدة."""
+    conn.executemany('''
+        INSERT INTO match_questions (match_id, question_index, question_text, correct_answer, options, difficulty, answered)
+        VALUES (?, ?, ?, ?, ?, ?, 0)
+    ''', [(match_id, idx, q['question'], q['correct'], ','.join(q['options']), q['difficulty'])
+          for idx, q in enumerate(questions)])
+    conn.execute("DELETE FROM match_participants WHERE match_id = ?", (match_id,))
+    conn.executemany("INSERT INTO match_participants (match_id, user_id, team_id) VALUES (?, ?, ?)",
+                     [(match_id, uid, team1_id) for uid in team1_players]
+                     + [(match_id, uid, team2_id) for uid in team2_players])
+
+def save_match_result(conn: sqlite3.Connection, match_id: int, score1: int, score2: int,
+                      winner_id: Optional[int], rating_rows: List[tuple]):
+    """على خيط الكاتب: نتيجة المباراة وتصنيفاتها الجديدة معاً، فلا تُحسب مباراة في أحدهما دون الآخر."""
+    conn.execute('''
+        UPDATE matches SET played=1, status='finished', score1=?, score2=?, winner_id=?
+        WHERE id=?
+    ''', (score1, score2, winner_id, match_id))
+    conn.executemany("INSERT OR REPLACE INTO ratings (kind, entity_id, rating, games) VALUES (?, ?, ?, ?)",
+                     rating_rows)
+
 async def start_match_by_id(context: ContextTypes.DEFAULT_TYPE, match_id: int):
     """بدء المباراة برقمها (دالة مساعدة)."""
-    match = db_execute('''
-        SELECT m.id, m.team1_id, m.team2_id, t1.name, t2.name
+    match = await database.fetch('''
+        SELECT m.id, m.tournament_id, m.team1_id, m.team2_id, t1.name, t2.name
         FROM matches m
         JOIN teams t1 ON m.team1_id = t1.id
         JOIN teams t2 ON m.team2_id = t2.id
@@ -270,36 +1310,24 @@ async def start_match_by_id(context: ContextTypes.DEFAULT_TYPE, match_id: int):
     ''', (match_id,))
     if not match:
         return
-    match_id, team1_id, team2_id, team1_name, team2_name = match[0]
+    match_id, tournament_id, team1_id, team2_id, team1_name, team2_name = match[0]
     # تحديث الحالة
-    db_execute("UPDATE matches SET status = 'active' WHERE id = ?", (match_id,))
+    await database.execute("UPDATE matches SET status = 'active' WHERE id = ?", (match_id,))
     team1_players = get_team_players(team1_id)
     team2_players = get_team_players(team2_id)
     if not team1_players or not team2_players:
-        logger.warning(f"المباراة {match_id}: أحد الفريقين بلا لاعبين، لن تبدأ.")
-        db_execute("UPDATE matches SET status = 'pending' WHERE id = ?", (match_id,))
-        return
-    # حساب boost الصعوبة بناءً على أداء الفرق السابق (إن وجد)
-    team1_stats = db_execute("SELECT correct_answers, played FROM team_stats WHERE team_id = ?", (team1_id,))
-    team2_stats = db_execute("SELECT correct_answers, played FROM team_stats WHERE team_id = ?", (team2_id,))
-    avg_correct = 0
-    if team1_stats and team1_stats[0][1] > 0:
-        avg_correct += team1_stats[0][0] / team1_stats[0][1]
-    if team2_stats and team2_stats[0][1] > 0:
-        avg_correct += team2_stats[0][0] / team2_stats[0][1]
-    avg_correct /= 2
-    difficulty_boost = 1.0 + (avg_correct / 25)  # كلما زادت الإجابات الصحيحة، زادت الصعوبة
+        logger.warning("المباراة %d: أحد الفريقين بلا لاعبين، لن تبدأ.", match_id,
+                       extra={'match_id': match_id})
+        await database.execute("UPDATE matches SET status = 'pending' WHERE id = ?", (match_id,))
+        return
+    # حساب boost الصعوبة من تصنيف الفريقين المخزن في الذاكرة
+    difficulty_boost = rating_difficulty_boost(rating_book.get('team', team1_id), rating_book.get('team', team2_id))
     questions = fetch_questions(25, difficulty_boost)
     if not questions:
-        logger.error(f"فشل جلب أسئلة للمباراة {match_id}")
-        db_execute("UPDATE matches SET status = 'pending' WHERE id = ?", (match_id,))
-        return
-    for idx, q in enumerate(questions):
-        options_str = ','.join(q['options'])
-        db_insert('''
-            INSERT INTO match_questions (match_id, question_index, question_text, correct_answer, options, difficulty, answered)
-            VALUES (?, ?, ?, ?, ?, ?, 0)
-        ''', (match_id, idx, q['question'], q['correct'], options_str, q['difficulty']))
+        logger.error("فشل جلب أسئلة للمباراة %d", match_id, extra={'match_id': match_id})
+        await database.execute("UPDATE matches SET status = 'pending' WHERE id = ?", (match_id,))
+        return
+    await database.run(store_match_start, match_id, questions, team1_id, team1_players, team2_id, team2_players)
     # إرسال إشعار للاعبين
     all_players = team1_players + team2_players
     for uid in all_players:
@@ -309,19 +1337,24 @@ async def start_match_by_id(context: ContextTypes.DEFAULT_TYPE, match_id: int):
                 _(uid, 'match_start', team1=team1_name, team2=team2_name, num=25)
             )
         except Exception as e:
-            logger.warning(f"لم نتمكن من إرسال رسالة للمستخدم {uid}: {e}")
+            logger.warning("لم نتمكن من إرسال رسالة للمستخدم %d: %s", uid, e,
+                           extra={'match_id': match_id, 'user_id': uid})
     # تخزين بيانات المباراة في الذاكرة
     if 'active_matches' not in context.bot_data:
         context.bot_data['active_matches'] = {}
     context.bot_data['active_matches'][match_id] = {
+        'tournament_id': tournament_id,
         'questions': questions,
         'team1_id': team1_id,
         'team2_id': team2_id,
         'team1_name': team1_name,
         'team2_name': team2_name,
         'players': all_players,
+        'team1_players': team1_players,
+        'team2_players': team2_players,
         'current_question': 0,
         'answered_questions': set(),
+        'asked_questions': set(),
     }
     # إرسال أول سؤال لكل لاعب
     for uid in all_players:
@@ -337,6 +1370,13 @@ async def send_question_to_player(context: ContextTypes.DEFAULT_TYPE, match_id:
     if q_index >= len(questions):
         return
     q = questions[q_index]
+    if q_index not in match_data['asked_questions']:
+        # وقت أول عرض للسؤال، لحساب زمن الإجابة في المعايرة
+        match_data['asked_questions'].add(q_index)
+        await database.execute("UPDATE match_questions SET asked_at = ? WHERE match_id = ? AND question_index = ?",
+                               (datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), match_id, q_index))
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     keyboard = [[InlineKeyboardButton(opt, callback_data=f"ans_{match_id}_{q_index}_{opt}")] for opt in q['options']]
     try:
         await context.bot.send_message(
@@ -345,7 +1385,8 @@ async def send_question_to_player(context: ContextTypes.DEFAULT_TYPE, match_id:
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     except Exception as e:
-        logger.warning(f"فشل إرسال السؤال للمستخدم {user_id}: {e}")
+        logger.warning("فشل إرسال السؤال للمستخدم %d: %s", user_id, e,
+                       extra={'match_id': match_id, 'user_id': user_id})
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -355,43 +1396,42 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(data) < 4:
         await query.edit_message_text("حدث خطأ في الإجابة.")
         return
-    _, match_id_str, q_index_str, answer = data[0], data[1], data[2], '_'.join(data[3:])
+    match_id_str, q_index_str, answer = data[1], data[2], '_'.join(data[3:])
     match_id = int(match_id_str)
     q_index = int(q_index_str)
-    match_data = context.bot_data['active_matches'].get(match_id)
+    match_data = context.bot_data.get('active_matches', {}).get(match_id)
     if not match_data:
         await query.edit_message_text("المباراة غير نشطة أو انتهت.")
         return
     # التحقق مما إذا كان هذا السؤال قد أجيب عليه مسبقاً
-    answered = db_execute("SELECT answered FROM match_questions WHERE match_id=? AND question_index=?", (match_id, q_index))
-    if answered and answered[0][0] == 1:
+    if q_index in match_data['answered_questions']:
         await query.edit_message_text("تمت الإجابة على هذا السؤال مسبقاً.")
         return
+    match_data['answered_questions'].add(q_index)
     # التحقق من صحة الإجابة
     correct_answer = match_data['questions'][q_index]['correct']
     is_correct = (answer == correct_answer)
-    # تسجيل الإجابة
-    db_insert('''
-        INSERT INTO player_answers (match_id, user_id, question_index, answer, is_correct)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (match_id, user_id, q_index, answer, is_correct))
-    # تحديث حالة السؤال إلى مُجاب
-    db_execute("UPDATE match_questions SET answered=1, answered_by=? WHERE match_id=? AND question_index=?", (user_id, match_id, q_index))
+    # تسجيل الإجابة في السجل (بعد fsync)؛ تُكتب إلى قاعدة البيانات مع الدفعة التالية
+    await answer_journal.record(match_id, user_id, q_index, answer, is_correct)
     # إرسال نتيجة الإجابة للاعب
     if is_correct:
         await query.edit_message_text(_(user_id, 'correct'))
     else:
         await query.edit_message_text(_(user_id, 'wrong', correct=correct_answer))
     # نتحقق مما إذا كانت كل الأسئلة قد أجيب عليها
-    total_questions = len(match_data['questions'])
-    answered_count = db_execute("SELECT COUNT(*) FROM match_questions WHERE match_id=? AND answered=1", (match_id,))[0][0]
-    if answered_count >= total_questions:
+    if len(match_data['answered_questions']) >= len(match_data['questions']):
         await finalize_match(context, match_id)
 
 async def finalize_match(context: ContextTypes.DEFAULT_TYPE, match_id: int):
+    if match_id not in context.bot_data['active_matches']:
+        return
+    # الحساب أدناه يقرأ player_answers، فننتظر حفظ كل الإجابات المعلقة قبل إخراج المباراة
+    # من active_matches؛ إن فشل الحفظ تبقى نشطة وتعيد check_scheduled_matches المحاولة
+    await answer_journal.flush()
     match_data = context.bot_data['active_matches'].pop(match_id, None)
     if not match_data:
         return
+    tournament_id = match_data['tournament_id']
     team1_id = match_data['team1_id']
     team2_id = match_data['team2_id']
     team1_name = match_data['team1_name']
@@ -399,18 +1439,19 @@ async def finalize_match(context: ContextTypes.DEFAULT_TYPE, match_id: int):
     # حساب إجابات كل فريق
     team1_correct = 0
     team2_correct = 0
-    team1_players = get_team_players(team1_id)
-    team2_players = get_team_players(team2_id)
-    for uid in team1_players:
-        res = db_execute("SELECT COUNT(*) FROM player_answers WHERE match_id=? AND user_id=? AND is_correct=1", (match_id, uid))
-        if res:
-            team1_correct += res[0][0]
-    for uid in team2_players:
-        res = db_execute("SELECT COUNT(*) FROM player_answers WHERE match_id=? AND user_id=? AND is_correct=1", (match_id, uid))
-        if res:
-            team2_correct += res[0][0]
+    # استعلام واحد لكل المباراة، ثم نوزع النتائج على الفريقين حسب تشكيلة بدء المباراة
+    team1_players = set(match_data['team1_players'])
+    team2_players = set(match_data['team2_players'])
+    per_user = await database.fetch(
+        "SELECT user_id, COUNT(*) FROM player_answers WHERE match_id=? AND is_correct=1 GROUP BY user_id",
+        (match_id,))
+    for uid, correct in per_user:
+        if uid in team1_players:
+            team1_correct += correct
+        elif uid in team2_players:
+            team2_correct += correct
     # تحديد أفضل لاعب
-    best_player = db_execute('''
+    best_player = await database.fetch('''
         SELECT u.user_id, u.first_name, COUNT(*) as correct
         FROM player_answers pa
         JOIN users u ON pa.user_id = u.user_id
@@ -423,23 +1464,23 @@ async def finalize_match(context: ContextTypes.DEFAULT_TYPE, match_id: int):
         mvp_id, mvp_name, mvp_correct = best_player[0]
         mvp_team = get_team_name(get_user_team(mvp_id))
     # تحديث إحصائيات الفرق حسب المرحلة
-    phase = db_execute("SELECT value FROM tournament WHERE key='phase'")[0][0]
+    phase = await get_phase(tournament_id)
     if phase == 'group':
         if team1_correct > team2_correct:
             winner_id = team1_id
             score1, score2 = 1, 0
-            db_execute("UPDATE team_stats SET played=played+1, wins=wins+1, points=points+3, correct_answers=correct_answers+? WHERE team_id=?", (team1_correct, team1_id))
-            db_execute("UPDATE team_stats SET played=played+1, losses=losses+1, correct_answers=correct_answers+? WHERE team_id=?", (team2_correct, team2_id))
+            await database.execute("UPDATE team_stats SET played=played+1, wins=wins+1, points=points+3, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team1_correct, tournament_id, team1_id))
+            await database.execute("UPDATE team_stats SET played=played+1, losses=losses+1, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team2_correct, tournament_id, team2_id))
         elif team2_correct > team1_correct:
             winner_id = team2_id
             score1, score2 = 0, 1
-            db_execute("UPDATE team_stats SET played=played+1, wins=wins+1, points=points+3, correct_answers=correct_answers+? WHERE team_id=?", (team2_correct, team2_id))
-            db_execute("UPDATE team_stats SET played=played+1, losses=losses+1, correct_answers=correct_answers+? WHERE team_id=?", (team1_correct, team1_id))
+            await database.execute("UPDATE team_stats SET played=played+1, wins=wins+1, points=points+3, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team2_correct, tournament_id, team2_id))
+            await database.execute("UPDATE team_stats SET played=played+1, losses=losses+1, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team1_correct, tournament_id, team1_id))
         else:
             winner_id = None
             score1, score2 = 0, 0
-            db_execute("UPDATE team_stats SET played=played+1, draws=draws+1, points=points+1, correct_answers=correct_answers+? WHERE team_id=?", (team1_correct, team1_id))
-            db_execute("UPDATE team_stats SET played=played+1, draws=draws+1, points=points+1, correct_answers=correct_answers+? WHERE team_id=?", (team2_correct, team2_id))
+            await database.execute("UPDATE team_stats SET played=played+1, draws=draws+1, points=points+1, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team1_correct, tournament_id, team1_id))
+            await database.execute("UPDATE team_stats SET played=played+1, draws=draws+1, points=points+1, correct_answers=correct_answers+? WHERE tournament_id=? AND team_id=?", (team2_correct, tournament_id, team2_id))
     else:
         # مرحلة خروج المغلوب
         if team1_correct == team2_correct:
@@ -451,14 +1492,17 @@ async def finalize_match(context: ContextTypes.DEFAULT_TYPE, match_id: int):
             winner_id = team2_id
         score1, score2 = (1,0) if winner_id == team1_id else (0,1)
         loser_id = team2_id if winner_id == team1_id else team1_id
-        db_execute("UPDATE teams SET active=0 WHERE id=?", (loser_id,))
-        db_execute("UPDATE team_stats SET correct_answers = correct_answers + ? WHERE team_id=?", (team1_correct, team1_id))
-        db_execute("UPDATE team_stats SET correct_answers = correct_answers + ? WHERE team_id=?", (team2_correct, team2_id))
-    # تحديث المباراة
-    db_execute('''
-        UPDATE matches SET played=1, status='finished', score1=?, score2=?, winner_id=?
-        WHERE id=?
-    ''', (score1, score2, winner_id, match_id))
+        await database.execute("UPDATE team_stats SET eliminated=1 WHERE tournament_id=? AND team_id=?", (tournament_id, loser_id))
+        await database.execute("UPDATE team_stats SET correct_answers = correct_answers + ? WHERE tournament_id=? AND team_id=?",
+                   (team1_correct, tournament_id, team1_id))
+        await database.execute("UPDATE team_stats SET correct_answers = correct_answers + ? WHERE tournament_id=? AND team_id=?",
+                   (team2_correct, tournament_id, team2_id))
+    # تحديث التصنيفات والمباراة معاً
+    score = 0.5 if winner_id is None else float(winner_id == team1_id)
+    async with rating_book.lock:
+        rating_rows = rating_book.update_match(team1_id, team2_id, score,
+                                               match_data['team1_players'], match_data['team2_players'])
+        await database.run(save_match_result, match_id, score1, score2, winner_id, rating_rows)
     # إرسال النتائج للمالك
     result_text = f"✅ انتهت المباراة {match_id}:\n{team1_name} {team1_correct} - {team2_correct} {team2_name}"
     if phase == 'group':
@@ -476,39 +1520,414 @@ async def finalize_match(context: ContextTypes.DEFAULT_TYPE, match_id: int):
         except:
             pass
     # التحقق من تقدم البطولة
-    await check_and_advance_knockout(context)
+    await check_and_advance_knockout(context, tournament_id)
 
-async def check_and_advance_knockout(context: ContextTypes.DEFAULT_TYPE):
-    phase = db_execute("SELECT value FROM tournament WHERE key='phase'")[0][0]
-    if phase != 'group':
+async def check_and_advance_knockout(context: ContextTypes.DEFAULT_TYPE, tournament_id: int):
+    if await get_phase(tournament_id) != 'group':
         return
-    pending_groups = db_execute("SELECT COUNT(*) FROM matches WHERE phase='group' AND played=0")
-    if pending_groups[0][0] > 0:
+    pending_groups = await database.fetch("SELECT 1 FROM matches WHERE tournament_id=? AND phase='group' AND played=0 LIMIT 1",
+                                (tournament_id,))
+    if pending_groups:
         return
     # انتهت المجموعات
     groups = ['A', 'B']
     qualified = []
     for group in groups:
-        stats = db_execute('''
+        stats = await database.fetch('''
             SELECT ts.team_id, ts.points, ts.correct_answers
             FROM team_stats ts
             JOIN teams t ON ts.team_id = t.id
-            WHERE ts.group_name = ? AND t.active = 1
+            WHERE ts.tournament_id = ? AND ts.group_name = ? AND ts.eliminated = 0 AND t.active = 1
             ORDER BY ts.points DESC, ts.correct_answers DESC
             LIMIT 2
-        ''', (group,))
+        ''', (tournament_id, group))
         if len(stats) < 2:
             await context.bot.send_message(OWNER_ID, f"⚠️ المجموعة {group} لا يوجد بها فريقان متبقيان!")
             return
         qualified.extend([row[0] for row in stats])
     # إنشاء مباريات نصف النهائي
-    db_insert("INSERT INTO matches (phase, round, team1_id, team2_id) VALUES ('knockout', 'semi', ?, ?)",
-              (qualified[0], qualified[3]))
-    db_insert("INSERT INTO matches (phase, round, team1_id, team2_id) VALUES ('knockout', 'semi', ?, ?)",
-              (qualified[2], qualified[1]))
-    db_execute("UPDATE tournament SET value='knockout' WHERE key='phase'")
+    await database.insert("INSERT INTO matches (tournament_id, phase, round, team1_id, team2_id) VALUES (?, 'knockout', 'semi', ?, ?)",
+              (tournament_id, qualified[0], qualified[3]))
+    await database.insert("INSERT INTO matches (tournament_id, phase, round, team1_id, team2_id) VALUES (?, 'knockout', 'semi', ?, ?)",
+              (tournament_id, qualified[2], qualified[1]))
+    await database.execute("UPDATE tournament SET value='knockout' WHERE tournament_id=? AND key='phase'", (tournament_id,))
     await context.bot.send_message(OWNER_ID, "🏆 انتهت مرحلة المجموعات! تم إنشاء مباريات نصف النهائي.")
 
+# ------------------ البث في الخلفية ------------------
+# كل شريحة استعلام مفهرس يعيد user_id بترتيب تصاعدي بعد المؤشر؛ المعاملات: (القيمة..., المؤشر, الحد)
+BROADCAST_SEGMENTS = {
+    'all': ("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", 0),
+    'lang': ("SELECT user_id FROM users WHERE lang = ? AND user_id > ? ORDER BY user_id LIMIT ?", 1),
+    'team': ("SELECT user_id FROM user_team WHERE team_id = ? AND user_id > ? ORDER BY user_id LIMIT ?", 1),
+    'phase': ('''SELECT DISTINCT user_id FROM user_team
+                 WHERE team_id IN (SELECT team1_id FROM matches WHERE tournament_id = ? AND phase = ?
+                                   UNION SELECT team2_id FROM matches WHERE tournament_id = ? AND phase = ?)
+                   AND user_id > ? ORDER BY user_id LIMIT ?''', 2),
+}
+
+# مهام البث الجارية في هذه العملية، حسب رقم المهمة
+broadcast_tasks: Dict[int, asyncio.Task] = {}
+
+def broadcast_segment_query(segment: str, value: Optional[str]) -> Tuple[str, tuple]:
+    """الاستعلام ومعاملات التصفية للشريحة؛ يضيف المستدعي (المؤشر, الحد)."""
+    query, n_values = BROADCAST_SEGMENTS[segment]
+    if segment == 'team':
+        value = int(value)
+    elif segment == 'phase':
+        # القيمة "رقم_البطولة:المرحلة"
+        tournament_id, phase = value.split(':', 1)
+        return query, (int(tournament_id), phase) * n_values
+    return query, (value,) * n_values
+
+def start_broadcast_task(bot, job_id: int):
+    task = asyncio.create_task(run_broadcast_job(bot, job_id))
+    broadcast_tasks[job_id] = task
+    task.add_done_callback(lambda _t: broadcast_tasks.pop(job_id, None))
+
+async def run_broadcast_job(bot, job_id: int):
+    """
+    إرسال رسالة البث على دفعات بدءاً من المؤشر المحفوظ. يُحفظ المؤشر بعد كل دفعة
+    وعند الإلغاء، فتستأنف المهمة بعد إعادة التشغيل من حيث توقفت.
+    """
+    from telegram.error import RetryAfter
+
+    row = await database.fetch('''
+        SELECT message, segment, segment_value, cursor, sent, failed, total, progress_chat_id, progress_message_id
+        FROM broadcast_jobs WHERE id = ? AND status = 'running'
+    ''', (job_id,))
+    if not row:
+        return
+    message, segment, segment_value, cursor, sent, failed, total, chat_id, message_id = row[0]
+    query, params = broadcast_segment_query(segment, segment_value)
+
+    async def checkpoint(status: str = 'running'):
+        await database.execute("UPDATE broadcast_jobs SET cursor=?, sent=?, failed=?, status=? WHERE id=?",
+                               (cursor, sent, failed, status, job_id))
+
+    async def report(text: str):
+        if not chat_id:
+            return
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.debug("تعذر تحديث رسالة تقدم البث %d: %s", job_id, e)
+
+    batches = 0
+    try:
+        while True:
+            user_ids = await database.fetch(query, params + (cursor, BROADCAST_BATCH))
+            if not user_ids:
+                break
+            for (uid,) in user_ids:
+                try:
+                    await bot.send_message(uid, message)
+                    sent += 1
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    try:
+                        await bot.send_message(uid, message)
+                        sent += 1
+                    except Exception:
+                        failed += 1
+                except Exception:
+                    failed += 1
+                cursor = uid
+                await asyncio.sleep(BROADCAST_DELAY)
+            await checkpoint()
+            batches += 1
+            if batches % BROADCAST_PROGRESS_EVERY == 0:
+                await report(f"📣 البث {job_id}: {sent + failed}/{total} (نجح {sent}، فشل {failed})")
+    except asyncio.CancelledError:
+        await checkpoint()
+        raise
+    await checkpoint('done')
+    await report(f"✅ اكتمل البث {job_id}: {sent} نجح، {failed} فشل.")
+
+async def resume_broadcast_jobs(bot) -> int:
+    """استئناف مهام البث التي لم تكتمل قبل إعادة التشغيل."""
+    jobs = await database.fetch("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+    for (job_id,) in jobs:
+        start_broadcast_task(bot, job_id)
+    return len(jobs)
+
+# ------------------ تصفح المباريات ------------------
+MATCH_FILTER_VALUES = {'phase': ('group', 'knockout'), 'status': ('pending', 'active', 'finished')}
+
+def parse_match_filters(args: List[str]) -> Dict[str, str]:
+    """phase=<..> status=<..> from=<YYYY-MM-DD> to=<YYYY-MM-DD>؛ يرفع ValueError عند خطأ."""
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep or key not in ('phase', 'status', 'from', 'to'):
+            raise ValueError(arg)
+        if key in ('from', 'to'):
+            datetime.strptime(value, '%Y-%m-%d')
+        elif value not in MATCH_FILTER_VALUES[key]:
+            raise ValueError(arg)
+        filters[key] = value
+    return filters
+
+def encode_match_filters(filters: Dict[str, str]) -> str:
+    """
+    المرشحات داخل callback_data لأزرار /matches، لا في user_data المشترك بين المحادثات والرسائل:
+    phase_status_from_to والتاريخ بلا شرطات (أطول نتيجة مع البادئة والرقم أقل من حد 64 بايت).
+    """
+    return "_".join(filters.get(key, '').replace('-', '') for key in ('phase', 'status', 'from', 'to'))
+
+def decode_match_filters(parts: List[str]) -> Dict[str, str]:
+    filters = {}
+    for key, value in zip(('phase', 'status', 'from', 'to'), parts):
+        if value:
+            filters[key] = f"{value[:4]}-{value[4:6]}-{value[6:]}" if key in ('from', 'to') else value
+    return filters
+
+async def fetch_matches_page(tournament_id: int, filters: Dict[str, str], after_id: Optional[int] = None,
+                       before_id: Optional[int] = None) -> Tuple[list, bool, bool]:
+    """
+    صفحة واحدة من المباريات مرتبة بالرقم، أو بالموعد ثم الرقم إذا حُددت نافذة زمنية (from/to)،
+    باستعلام واحد محدود بـ MATCHES_PAGE_SIZE + 1 يقرأ الفهرس بترتيب الصفحة دون فرز.
+    after_id/before_id رقم آخر/أول مباراة في الصفحة الحالية؛ في النافذة الزمنية يُقرأ موعدها
+    من الجدول ليكون المفتاح (scheduled_time, id).
+    تعيد (الصفوف، هل توجد صفحة سابقة، هل توجد صفحة تالية).
+    """
+    where, params = ["m.tournament_id = ?"], [tournament_id]
+    if 'phase' in filters:
+        where.append("m.phase = ?")
+        params.append(filters['phase'])
+    if 'status' in filters:
+        where.append("m.status = ?")
+        params.append(filters['status'])
+    if 'from' in filters:
+        where.append("m.scheduled_time >= ?")
+        params.append(filters['from'])
+    if 'to' in filters:
+        where.append("m.scheduled_time < ?")
+        params.append((datetime.strptime(filters['to'], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    backwards = before_id is not None
+    anchor = before_id if backwards else after_id
+    windowed = 'from' in filters or 'to' in filters
+    key = "(m.scheduled_time, m.id)" if windowed else "m.id"
+    if anchor is not None:
+        where.append(f"{key} {'<' if backwards else '>'} "
+                     + ("((SELECT scheduled_time FROM matches WHERE id = ?), ?)" if windowed else "?"))
+        params += [anchor, anchor] if windowed else [anchor]
+    order = "m.scheduled_time, m.id" if windowed else "m.id"
+    if backwards:
+        order = order.replace(",", " DESC,") + " DESC"
+    rows = await database.fetch(f'''
+        SELECT m.id, m.phase, m.round, t1.name, t2.name, m.played, m.status, m.scheduled_time, m.winner_id
+        FROM matches m
+        JOIN teams t1 ON m.team1_id = t1.id
+        JOIN teams t2 ON m.team2_id = t2.id
+        WHERE {" AND ".join(where)}
+        ORDER BY {order}
+        LIMIT ?
+    ''', tuple(params) + (MATCHES_PAGE_SIZE + 1,))
+    more = len(rows) > MATCHES_PAGE_SIZE
+    rows = rows[:MATCHES_PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+        return rows, more, True
+    return rows, after_id is not None, more
+
+def pager_keyboard(prefix: str, rows: list, has_prev: bool, has_next: bool,
+                   suffix: str = "") -> Optional[InlineKeyboardMarkup]:
+    """suffix يُلحق بـ callback_data بعد الرقم (مرشحات /matches المرمزة)."""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"{prefix}_p_{rows[0][0]}{suffix}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("التالي ➡️", callback_data=f"{prefix}_n_{rows[-1][0]}{suffix}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def render_matches_page(rows: list) -> str:
+    lines = []
+    for m in rows:
+        status_emoji = "✅" if m[5] else "🔄" if m[6]=='active' else "⏳"
+        scheduled = f" (مجدولة: {m[7]})" if m[7] else ""
+        lines.append(f"{status_emoji} ID {m[0]} | {m[1]} - {m[2]}: {m[3]} vs {m[4]}{scheduled}")
+    return "📅 المباريات:\n" + "\n".join(lines)
+
+def render_knockout_page(rows: list) -> str:
+    text = "🏆 مرحلة خروج المغلوب:\n"
+    for m in rows:
+        status = "✅" if m[5] else "⏳"
+        if m[5]:
+            text += f"{status} {m[2]}: {m[3]} vs {m[4]} -> الفائز {get_team_name(m[8])}\n"
+        else:
+            text += f"{status} {m[2]}: {m[3]} vs {m[4]}\n"
+    return text
+
+# ------------------ أرشفة البطولات المنتهية ------------------
+_TOURNAMENT_MATCHES = "match_id IN (SELECT id FROM matches WHERE tournament_id = ?)"
+_PLAYED_MATCHES = "match_id IN (SELECT id FROM matches WHERE tournament_id = ? AND played = 1)"
+# الجداول المنقولة إلى ملف الأرشيف وشرط صفوف البطولة في كل منها (الحذف بالترتيب العكسي)
+ARCHIVE_TABLES = [
+    ('matches', "tournament_id = ?"),
+    ('match_questions', _TOURNAMENT_MATCHES),
+    ('player_answers', _TOURNAMENT_MATCHES),
+    ('match_participants', _TOURNAMENT_MATCHES),
+    ('team_stats', "tournament_id = ?"),
+    ('tournament', "tournament_id = ?"),
+]
+# تشكيلات المباريات الملعوبة تبقى في القاعدة بعد الأرشفة، يعيد منها /rerate تصنيف اللاعبين
+ARCHIVE_KEEP = {'match_participants': _PLAYED_MATCHES}
+
+def fold_archived_history(conn: sqlite3.Connection, tournament_id: int):
+    """
+    قبل حذف صفوف البطولة: ما يحتاجه /rerate و /calibrate يبقى في القاعدة كملخصات، وهي نتائج
+    المباريات الملعوبة، وإجماليات الإجابات لكل سؤال ولكل ثانية من زمن الإجابة ولكل فريق في كل مباراة.
+    الأوقات مخزنة بدقة الثانية فمدرج latency_totals لا يفقد شيئاً من الوسيط.
+    """
+    conn.execute('''
+        INSERT OR IGNORE INTO match_results (match_id, team1_id, team2_id, winner_id)
+        SELECT id, team1_id, team2_id, winner_id FROM matches WHERE tournament_id = ? AND played = 1
+    ''', (tournament_id,))
+    answers = f'''
+        FROM player_answers pa
+        JOIN match_questions mq ON mq.match_id = pa.match_id AND mq.question_index = pa.question_index
+        WHERE pa.{_TOURNAMENT_MATCHES}'''
+    conn.execute(f'''
+        INSERT INTO question_totals (question_text, difficulty, answers, correct)
+        SELECT mq.question_text, COALESCE(mq.difficulty, ''), COUNT(*), SUM(pa.is_correct = 1) {answers}
+        GROUP BY 1, 2
+        ON CONFLICT(question_text, difficulty) DO UPDATE SET
+            answers = answers + excluded.answers, correct = correct + excluded.correct
+    ''', (tournament_id,))
+    conn.execute(f'''
+        INSERT INTO latency_totals (question_text, difficulty, seconds, answers)
+        SELECT mq.question_text, COALESCE(mq.difficulty, ''),
+               CAST(ROUND((julianday(pa.answered_at) - julianday(mq.asked_at)) * 86400.0) AS INTEGER),
+               COUNT(*) {answers} AND pa.answered_at IS NOT NULL AND mq.asked_at IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT(question_text, difficulty, seconds) DO UPDATE SET answers = answers + excluded.answers
+    ''', (tournament_id,))
+    # فريق اللاعب في المباراة نفسها (match_participants)، كما تنسب compute_question_analytics الإجابات الحية
+    conn.execute(f'''
+        INSERT OR REPLACE INTO team_match_totals (team_id, match_id, answers, correct)
+        SELECT mp.team_id, pa.match_id, COUNT(*), SUM(pa.is_correct = 1)
+        FROM player_answers pa
+        JOIN match_questions mq ON mq.match_id = pa.match_id AND mq.question_index = pa.question_index
+        JOIN match_participants mp ON mp.match_id = pa.match_id AND mp.user_id = pa.user_id
+        WHERE pa.{_TOURNAMENT_MATCHES}
+        GROUP BY mp.team_id, pa.match_id
+    ''', (tournament_id,))
+
+def restore_archived_history(c: sqlite3.Cursor):
+    """
+    ترحيل: ملخصات البطولات المؤرشفة قبل وجود fold_archived_history تُبنى من ملفاتها، بتحميل صفوف
+    كل ملف إلى جداول مؤقتة بنفس الأسماء تحجب الجداول الأصلية. الملف المفقود يُتجاوز مع تحذير.
+    """
+    for tournament_id, path in c.execute("SELECT tournament_id, path FROM tournament_archive ORDER BY id").fetchall():
+        if not os.path.exists(path):
+            logger.warning("ملف الأرشيف %s غير موجود؛ لن تدخل البطولة %d في إعادة الحساب", path, tournament_id)
+            continue
+        for table, _where in ARCHIVE_TABLES:
+            c.execute(f"CREATE TEMP TABLE {table} AS SELECT * FROM main.{table} WHERE 0")
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                row = rec['row']
+                c.execute(f"INSERT INTO temp.{rec['table']} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                          list(row.values()))
+        # الأرشيفات الأقدم بلا تشكيلات: أعضاء الفريقين الحاليون كما في ترحيل match_participants،
+        # قبل fold_archived_history لأنها تنسب الإجابات إلى الفرق من التشكيلات
+        c.execute('''
+            INSERT INTO temp.match_participants (match_id, user_id, team_id)
+            SELECT m.id, ut.user_id, ut.team_id FROM temp.matches m
+            JOIN user_team ut ON ut.team_id IN (m.team1_id, m.team2_id)
+            WHERE m.played = 1 AND m.id NOT IN (SELECT match_id FROM temp.match_participants)
+        ''')
+        fold_archived_history(c, tournament_id)
+        c.execute(f"INSERT OR IGNORE INTO main.match_participants SELECT * FROM temp.match_participants "
+                  f"WHERE {_PLAYED_MATCHES}", (tournament_id,))
+        for table, _where in ARCHIVE_TABLES:
+            c.execute(f"DROP TABLE temp.{table}")
+
+async def tournament_finished(tournament_id: int) -> bool:
+    """البطولة منتهية إذا بلغت خروج المغلوب ولُعبت كل مبارياتها."""
+    if await get_phase(tournament_id) != 'knockout':
+        return False
+    pending = await database.fetch("SELECT 1 FROM matches WHERE tournament_id = ? AND played = 0 LIMIT 1",
+                                   (tournament_id,))
+    return not pending
+
+def archive_tournament(conn: sqlite3.Connection, tournament_id: int, path: str) -> Dict[str, int]:
+    """
+    على خيط الكاتب: نسخ صفوف البطولة إلى ملف JSON lines مضغوط (سطر {"table", "row"} لكل صف)،
+    ثم إضافة إجماليات اللاعبين إلى player_totals وملخصات fold_archived_history وحذف الصفوف
+    من القاعدة (عدا ARCHIVE_KEEP) في نفس المعاملة.
+    """
+    counts = {}
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for table, where in ARCHIVE_TABLES:
+            cur = conn.execute(f"SELECT * FROM {table} WHERE {where}", (tournament_id,))
+            columns = [d[0] for d in cur.description]
+            counts[table] = 0
+            for row in cur:
+                f.write(json.dumps({'table': table, 'row': dict(zip(columns, row))}, ensure_ascii=False) + "\n")
+                counts[table] += 1
+    os.replace(tmp_path, path)
+    conn.execute(f'''
+        INSERT INTO player_totals (user_id, matches, correct, wrong)
+        SELECT user_id, COUNT(DISTINCT match_id), SUM(is_correct = 1), SUM(is_correct = 0)
+        FROM player_answers WHERE {_TOURNAMENT_MATCHES} GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET matches = matches + excluded.matches,
+            correct = correct + excluded.correct, wrong = wrong + excluded.wrong
+    ''', (tournament_id,))
+    conn.execute("INSERT INTO tournament_archive (tournament_id, path, matches, answers) VALUES (?, ?, ?, ?)",
+                 (tournament_id, path, counts['matches'], counts['player_answers']))
+    fold_archived_history(conn, tournament_id)
+    for table, where in reversed(ARCHIVE_TABLES):
+        if table in ARCHIVE_KEEP:
+            where = f"{where} AND NOT {ARCHIVE_KEEP[table]}"
+        conn.execute(f"DELETE FROM {table} WHERE {where}", (tournament_id,) * where.count("?"))
+    return counts
+
+def compact_database(conn: sqlite3.Connection, full: bool = False) -> int:
+    """
+    إعادة الصفحات الحرة إلى نظام الملفات، ويعيد عدد الصفحات المحررة.
+    القاعدة المنشأة قبل auto_vacuum=INCREMENTAL تحتاج VACUUM كاملاً مرة واحدة للتحويل، وهو يحجز
+    خيط الكاتب طوال نسخ القاعدة؛ لذلك لا يُنفذ إلا مع full (من compaction_job عند الخمول).
+    """
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if not full:
+            return 0
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # executescript يخطو الأمر حتى نهايته؛ execute يحرر صفحة واحدة فقط لكل خطوة
+        conn.executescript("PRAGMA incremental_vacuum")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return before - conn.execute("PRAGMA page_count").fetchone()[0]
+
+async def archive_to_file(tournament_id: int) -> Tuple[str, Dict[str, int]]:
+    """
+    أرشفة صفوف البطولة دون ضغط القاعدة؛ يعيد (مسار الملف، عدد الصفوف لكل جدول).
+    تُستخدم عند إعادة الضبط: الضغط يحجز خيط الكاتب عن بطولات المحادثات الأخرى.
+    """
+    await answer_journal.flush()
+    os.makedirs(ARCHIVE_PATH, exist_ok=True)
+    stem = os.path.join(ARCHIVE_PATH, f"tournament_{tournament_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    path, n = stem + ".jsonl.gz", 1
+    while os.path.exists(path):
+        n += 1
+        path = f"{stem}_{n}.jsonl.gz"
+    counts = await database.run(archive_tournament, tournament_id, path)
+    logger.info("أُرشفت البطولة %d في %s (%s)", tournament_id, path, counts)
+    return path, counts
+
+async def archive_and_compact(tournament_id: int) -> Tuple[str, Dict[str, int], int]:
+    """أرشفة صفوف البطولة ثم ضغط تدريجي للقاعدة؛ يعيد (مسار الملف، عدد الصفوف لكل جدول، الصفحات المحررة)."""
+    path, counts = await archive_to_file(tournament_id)
+    freed = await database.run(compact_database)
+    logger.info("حُررت %d صفحة بعد أرشفة البطولة %d", freed, tournament_id)
+    return path, counts, freed
+
 # ------------------ أوامر المالك ------------------
 async def owner_add_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
@@ -517,15 +1936,33 @@ async def owner_add_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ استخدم: /addteam <اسم الفريق>")
         return
     name = " ".join(context.args).strip()
-    count = db_execute("SELECT COUNT(*) FROM teams WHERE active=1")[0][0]
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    count = len(team_index.active_teams(tournament_id))
     if count >= 8:
         await update.message.reply_text("❌ لا يمكن إضافة المزيد من الفرق، الحد الأقصى 8.")
         return
+    # فريق موجود في بطولة أخرى يُضاف بلاعبيه إلى هذه البطولة
+    team_id = get_team_id(name)
+    if team_id in team_index.teams_by_tournament.get(tournament_id, []):
+        await update.message.reply_text(f"❌ الفريق موجود بالفعل.")
+        return
+
+    def add(conn):
+        new_id = team_id
+        if new_id is None:
+            new_id = conn.execute("INSERT INTO teams (name, active) VALUES (?, 1)", (name,)).lastrowid
+        conn.execute("INSERT OR IGNORE INTO tournament_teams (tournament_id, team_id) VALUES (?, ?)",
+                     (tournament_id, new_id))
+        return new_id
     try:
-        db_insert("INSERT INTO teams (name, active) VALUES (?, 1)", (name,))
-        await update.message.reply_text(f"✅ تم إضافة الفريق {name}.")
+        new_id = await database.run(add)
     except sqlite3.IntegrityError:
         await update.message.reply_text(f"❌ الفريق موجود بالفعل.")
+        return
+    if team_id is None:
+        team_index.add_team(new_id, name)
+    team_index.enter(tournament_id, new_id)
+    await update.message.reply_text(f"✅ تم إضافة الفريق {name}.")
 
 async def owner_del_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
@@ -534,41 +1971,63 @@ async def owner_del_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ استخدم: /delteam <اسم الفريق>")
         return
     name = " ".join(context.args).strip()
+    tournament_id = await get_tournament_id(update.effective_chat.id)
     team_id = get_team_id(name)
-    if not team_id:
+    if not team_id or team_id not in team_index.teams_by_tournament.get(tournament_id, []):
         await update.message.reply_text("❌ الفريق غير موجود.")
         return
-    db_execute("DELETE FROM teams WHERE id = ?", (team_id,))
+    # يُحذف الفريق نفسه فقط إن لم يبق في أي بطولة أخرى
+    elsewhere = [tid for tid in team_index.tournaments_of(team_id) if tid != tournament_id]
+
+    def delete(conn):
+        conn.execute("DELETE FROM tournament_teams WHERE tournament_id = ? AND team_id = ?", (tournament_id, team_id))
+        if not elsewhere:
+            conn.execute("DELETE FROM teams WHERE id = ?", (team_id,))
+            # المفاتيح الأجنبية غير مفعّلة في sqlite افتراضياً، لذا نحذف العضويات صراحةً
+            conn.execute("DELETE FROM user_team WHERE team_id = ?", (team_id,))
+    await database.run(delete)
+    if elsewhere:
+        team_index.withdraw(tournament_id, team_id)
+    else:
+        team_index.remove_team(team_id)
     await update.message.reply_text(f"✅ تم حذف الفريق {name}.")
 
 async def owner_start_tournament(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    teams = db_execute("SELECT id, name FROM teams WHERE active=1")
-    team_ids = [row[0] for row in teams]
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    # فرق هذه البطولة فقط (المضافة بـ /addteam في هذه المحادثة)
+    team_ids = [row[0] for row in team_index.active_teams(tournament_id)]
     if len(team_ids) < 2:
         await update.message.reply_text("❌ يجب وجود فريقين على الأقل.")
         return
-    db_execute("DELETE FROM matches")
-    db_execute("DELETE FROM team_stats")
-    db_execute("DELETE FROM tournament")
-    db_execute("INSERT INTO tournament (key, value) VALUES ('phase', 'group')")
+    # البطولة السابقة، منتهية أو لا، تُؤرشف بكل صفوفها (أسئلتها وإجاباتها معها) بدل حذفها،
+    # وتتوقف مبارياتها الجارية كي لا تُكتب إجابات لمباريات محذوفة
+    if await database.fetch("SELECT 1 FROM matches WHERE tournament_id = ? LIMIT 1", (tournament_id,)):
+        active = context.bot_data.setdefault('active_matches', {})
+        for match_id in [mid for mid, m in active.items() if m['tournament_id'] == tournament_id]:
+            del active[match_id]
+        await archive_to_file(tournament_id)
     random.shuffle(team_ids)
     mid = (len(team_ids) + 1) // 2
     group_a_ids = team_ids[:mid]
     group_b_ids = team_ids[mid:]
-    for tid in group_a_ids:
-        db_insert("INSERT INTO team_stats (team_id, group_name) VALUES (?, 'A')", (tid,))
-    for tid in group_b_ids:
-        db_insert("INSERT INTO team_stats (team_id, group_name) VALUES (?, 'B')", (tid,))
-    for i in range(len(group_a_ids)):
-        for j in range(i+1, len(group_a_ids)):
-            db_insert("INSERT INTO matches (phase, round, group_name, team1_id, team2_id) VALUES (?, ?, ?, ?, ?)",
-                      ("group", "group", "A", group_a_ids[i], group_a_ids[j]))
-    for i in range(len(group_b_ids)):
-        for j in range(i+1, len(group_b_ids)):
-            db_insert("INSERT INTO matches (phase, round, group_name, team1_id, team2_id) VALUES (?, ?, ?, ?, ?)",
-                      ("group", "group", "B", group_b_ids[i], group_b_ids[j]))
+    stats, fixtures = [], []
+    for group_name, ids in (("A", group_a_ids), ("B", group_b_ids)):
+        stats += [(tournament_id, tid, group_name) for tid in ids]
+        fixtures += [(tournament_id, "group", "group", group_name, ids[i], ids[j])
+                     for i in range(len(ids)) for j in range(i+1, len(ids))]
+
+    # إعادة ضبط بطولة هذه المحادثة فقط وإنشاء الجدول في معاملة واحدة على خيط الكاتب
+    def reset(conn):
+        conn.execute("DELETE FROM matches WHERE tournament_id = ?", (tournament_id,))
+        conn.execute("DELETE FROM team_stats WHERE tournament_id = ?", (tournament_id,))
+        conn.execute("DELETE FROM tournament WHERE tournament_id = ?", (tournament_id,))
+        conn.execute("INSERT INTO tournament (tournament_id, key, value) VALUES (?, 'phase', 'group')", (tournament_id,))
+        conn.executemany("INSERT INTO team_stats (tournament_id, team_id, group_name) VALUES (?, ?, ?)", stats)
+        conn.executemany("INSERT INTO matches (tournament_id, phase, round, group_name, team1_id, team2_id) VALUES (?, ?, ?, ?, ?, ?)",
+                         fixtures)
+    await database.run(reset)
     names_a = [get_team_name(tid) for tid in group_a_ids]
     names_b = [get_team_name(tid) for tid in group_b_ids]
     text = "✅ بدأت البطولة!\nالمجموعة A:\n" + "\n".join(f"• {n}" for n in names_a)
@@ -595,7 +2054,9 @@ async def owner_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'السبت': (5 - now.weekday()) % 7
         }[day]
         scheduled_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_until if days_until > 0 else 7)
-        db_execute("UPDATE matches SET scheduled_time = ? WHERE id = ?", (scheduled_date.isoformat(), match_id))
+        tournament_id = await get_tournament_id(update.effective_chat.id)
+        await database.execute("UPDATE matches SET scheduled_time = ? WHERE id = ? AND tournament_id = ?",
+                   (scheduled_date.isoformat(), match_id, tournament_id))
         await update.message.reply_text(f"✅ تم جدولة المباراة {match_id} في {day} {time_str}.")
         # جدولة تذكير قبل نصف ساعة
         reminder_time = scheduled_date - timedelta(minutes=30)
@@ -623,7 +2084,9 @@ async def owner_reschedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'السبت': (5 - now.weekday()) % 7
         }[day]
         scheduled_date = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_until if days_until > 0 else 7)
-        db_execute("UPDATE matches SET scheduled_time = ? WHERE id = ?", (scheduled_date.isoformat(), match_id))
+        tournament_id = await get_tournament_id(update.effective_chat.id)
+        await database.execute("UPDATE matches SET scheduled_time = ? WHERE id = ? AND tournament_id = ?",
+                   (scheduled_date.isoformat(), match_id, tournament_id))
         await update.message.reply_text(f"✅ تم تعديل موعد المباراة {match_id} إلى {day} {time_str}.")
     except Exception as e:
         await update.message.reply_text(f"❌ خطأ في الإدخال: {e}")
@@ -636,7 +2099,8 @@ async def owner_unschedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         match_id = int(context.args[0])
-        db_execute("UPDATE matches SET scheduled_time = NULL WHERE id = ?", (match_id,))
+        await database.execute("UPDATE matches SET scheduled_time = NULL WHERE id = ? AND tournament_id = ?",
+                   (match_id, await get_tournament_id(update.effective_chat.id)))
         await update.message.reply_text(f"✅ تم إلغاء جدولة المباراة {match_id}.")
     except:
         await update.message.reply_text("❌ رقم غير صالح.")
@@ -645,19 +2109,36 @@ async def owner_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
     if not context.args:
-        await update.message.reply_text("❗ استخدم: /broadcast <الرسالة>")
+        await update.message.reply_text(
+            "❗ استخدم: /broadcast [lang=<ar|en> | team=<اسم> | phase=<group|knockout>] <الرسالة>")
         return
-    message = " ".join(context.args)
-    users = db_execute("SELECT user_id FROM users")
-    sent = 0
-    failed = 0
-    for (uid,) in users:
-        try:
-            await context.bot.send_message(uid, message)
-            sent += 1
-        except:
-            failed += 1
-    await update.message.reply_text(f"✅ تم الإرسال: {sent} نجح، {failed} فشل.")
+    args = list(context.args)
+    segment, segment_value = 'all', None
+    key, sep, value = args[0].partition('=')
+    if sep and key in BROADCAST_SEGMENTS:
+        segment, segment_value = key, value
+        args = args[1:]
+        if segment == 'team':
+            team_id = get_team_id(value)
+            if not team_id:
+                await update.message.reply_text("❌ الفريق غير موجود.")
+                return
+            segment_value = str(team_id)
+        elif segment == 'phase':
+            tournament_id = await get_tournament_id(update.effective_chat.id)
+            segment_value = f"{tournament_id}:{value}"
+    if not args:
+        await update.message.reply_text("❗ الرسالة فارغة.")
+        return
+    message = " ".join(args)
+    query, params = broadcast_segment_query(segment, segment_value)
+    total = (await database.fetch(f"SELECT COUNT(*) FROM ({query})", params + (0, -1)))[0][0]
+    progress = await update.message.reply_text(f"📣 بدأ البث إلى {total} مستخدم...")
+    job_id = await database.insert('''
+        INSERT INTO broadcast_jobs (message, segment, segment_value, total, progress_chat_id, progress_message_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (message, segment, segment_value, total, progress.chat_id, progress.message_id))
+    start_broadcast_task(context.bot, job_id)
 
 async def owner_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
@@ -667,7 +2148,14 @@ async def owner_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         backup_filename = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         if not os.path.exists(BACKUP_PATH):
             os.makedirs(BACKUP_PATH)
-        shutil.copy2(DB_PATH, os.path.join(BACKUP_PATH, backup_filename))
+        # واجهة النسخ في sqlite تتضمن ما في ملف WAL بخلاف نسخ الملف مباشرة
+        def backup(conn):
+            dest = sqlite3.connect(os.path.join(BACKUP_PATH, backup_filename))
+            try:
+                conn.backup(dest)
+            finally:
+                dest.close()
+        await database.run(backup)
         with open(os.path.join(BACKUP_PATH, backup_filename), 'rb') as f:
             await update.message.reply_document(f, filename=backup_filename)
         await update.message.reply_text("✅ تم إنشاء نسخة احتياطية وإرسالها.")
@@ -677,59 +2165,113 @@ async def owner_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def owner_matches(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    matches = db_execute('''
-        SELECT m.id, m.phase, m.round, t1.name, t2.name, m.played, m.status, m.scheduled_time
-        FROM matches m
-        JOIN teams t1 ON m.team1_id = t1.id
-        JOIN teams t2 ON m.team2_id = t2.id
-        ORDER BY m.id
-    ''')
-    if not matches:
+    try:
+        filters = parse_match_filters(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "❗ استخدم: /matches [phase=<group|knockout>] [status=<pending|active|finished>] "
+            "[from=YYYY-MM-DD] [to=YYYY-MM-DD]")
+        return
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    rows, has_prev, has_next = await fetch_matches_page(tournament_id, filters)
+    if not rows:
         await update.message.reply_text("لا توجد مباريات.")
         return
-    lines = []
-    for m in matches:
-        status_emoji = "✅" if m[5] else "🔄" if m[6]=='active' else "⏳"
-        scheduled = f" (مجدولة: {m[7]})" if m[7] else ""
-        lines.append(f"{status_emoji} ID {m[0]} | {m[1]} - {m[2]}: {m[3]} vs {m[4]}{scheduled}")
-    await update.message.reply_text("📅 المباريات:\n" + "\n".join(lines))
+    await update.message.reply_text(render_matches_page(rows),
+                                    reply_markup=pager_keyboard("mpg", rows, has_prev, has_next,
+                                                                "_" + encode_match_filters(filters)))
+
+async def owner_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أزرار التالي/السابق لـ /matches (mpg) ولمرحلة خروج المغلوب في /standings (spg)."""
+    query = update.callback_query
+    await query.answer()
+    if not is_owner(query.from_user.id):
+        return
+    prefix, direction, anchor, *encoded = query.data.split('_')
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    suffix = ""
+    if prefix == 'mpg':
+        # المرشحات من الزر نفسه: كل رسالة تتصفح بمرشحاتها ولو تعددت المحادثات
+        filters = decode_match_filters(encoded)
+        suffix = "_" + encode_match_filters(filters)
+        render = render_matches_page
+    else:
+        filters = {'phase': 'knockout'}
+        render = render_knockout_page
+    if direction == 'n':
+        rows, has_prev, has_next = await fetch_matches_page(tournament_id, filters, after_id=int(anchor))
+    else:
+        rows, has_prev, has_next = await fetch_matches_page(tournament_id, filters, before_id=int(anchor))
+    if not rows:
+        return
+    await query.edit_message_text(render(rows), reply_markup=pager_keyboard(prefix, rows, has_prev, has_next, suffix))
 
 async def owner_standings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    phase = db_execute("SELECT value FROM tournament WHERE key='phase'")[0][0]
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    phase = await get_phase(tournament_id)
+    if phase is None:
+        await update.message.reply_text("لم تبدأ بطولة في هذه المحادثة.")
+        return
     if phase == 'group':
         groups = ['A', 'B']
         text = "📊 ترتيب المجموعات:\n"
         for group in groups:
-            stats = db_execute('''
+            stats = await database.fetch('''
                 SELECT t.name, ts.played, ts.wins, ts.draws, ts.losses, ts.points, ts.correct_answers
                 FROM team_stats ts
                 JOIN teams t ON ts.team_id = t.id
-                WHERE ts.group_name = ? AND t.active = 1
+                WHERE ts.tournament_id = ? AND ts.group_name = ? AND ts.eliminated = 0 AND t.active = 1
                 ORDER BY ts.points DESC, ts.correct_answers DESC
-            ''', (group,))
+            ''', (tournament_id, group))
             if stats:
                 text += f"\nالمجموعة {group}:\n"
                 for row in stats:
                     text += f"{row[0]}: {row[5]} نقاط (لعب {row[1]}، فوز {row[2]}، تعادل {row[3]}، خسارة {row[4]}، إجابات صحيحة {row[6]})\n"
     else:
-        text = "🏆 مرحلة خروج المغلوب:\n"
-        matches = db_execute('''
-            SELECT m.id, m.round, t1.name, t2.name, m.played, m.winner_id
-            FROM matches m
-            JOIN teams t1 ON m.team1_id = t1.id
-            JOIN teams t2 ON m.team2_id = t2.id
-            WHERE m.phase='knockout'
-            ORDER BY m.id
-        ''')
-        for m in matches:
-            status = "✅" if m[4] else "⏳"
-            if m[4]:
-                winner = get_team_name(m[5])
-                text += f"{status} {m[1]}: {m[2]} vs {m[3]} -> الفائز {winner}\n"
-            else:
-                text += f"{status} {m[1]}: {m[2]} vs {m[3]}\n"
+        rows, has_prev, has_next = await fetch_matches_page(tournament_id, {'phase': 'knockout'})
+        await update.message.reply_text(render_knockout_page(rows),
+                                        reply_markup=pager_keyboard("spg", rows, has_prev, has_next))
+        return
+    await update.message.reply_text(text)
+
+async def owner_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نقل بطولة المحادثة المنتهية إلى ملف أرشيف مضغوط وإبقاء ملخصها في القاعدة."""
+    if not is_owner(update.effective_user.id):
+        return
+    tournament_id = await get_tournament_id(update.effective_chat.id)
+    if not await tournament_finished(tournament_id):
+        await update.message.reply_text("❌ لا توجد بطولة منتهية في هذه المحادثة.")
+        return
+    try:
+        path, counts, freed = await archive_and_compact(tournament_id)
+    except (OSError, sqlite3.Error) as e:
+        logger.exception("فشلت أرشفة البطولة %d", tournament_id)
+        await update.message.reply_text(f"❌ فشلت الأرشفة: {e}")
+        return
+    await update.message.reply_text(
+        f"✅ أُرشفت البطولة في {path}\n"
+        f"المباريات: {counts['matches']}، الإجابات: {counts['player_answers']}، الصفحات المحررة: {freed}")
+
+async def owner_calibrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معايرة صعوبة الأسئلة الآن بدل انتظار المهمة اليومية."""
+    if not is_owner(update.effective_user.id):
+        return
+    result = await run_calibration()
+    lines = [f"{d}: {round(rate * 100)}% من {n}" + (f"، وسيط الزمن {lat:.0f}ث" if lat is not None else "")
+             for d, n, rate, lat in result['difficulties']]
+    await update.message.reply_text(f"✅ المعايرة: {result['answers']} إجابة، {len(result['questions'])} سؤال\n"
+                                    + "\n".join(lines))
+
+async def owner_rerate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة حساب كل التصنيفات من سجل المباريات (بعد استيراد بيانات أو تعديل يدوي)."""
+    if not is_owner(update.effective_user.id):
+        return
+    result = await rerate()
+    teams = sorted(((r, tid) for (kind, tid), r in result.items() if kind == 'team'), reverse=True)[:10]
+    text = "✅ أعيد حساب التصنيفات.\n" + "\n".join(
+        f"{get_team_name(tid) or tid}: {round(r)}" for r, tid in teams)
     await update.message.reply_text(text)
 
 async def owner_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -737,16 +2279,19 @@ async def owner_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     text = (
         "⚽ أوامر المالك:\n"
-        "/addteam <اسم> - إضافة فريق\n"
-        "/delteam <اسم> - حذف فريق\n"
-        "/start_tournament - بدء البطولة (تقسيم المجموعات)\n"
+        "/addteam <اسم> - إضافة فريق إلى بطولة هذه المحادثة\n"
+        "/delteam <اسم> - حذف فريق من بطولة هذه المحادثة\n"
+        "/start_tournament - بدء بطولة هذه المحادثة (تقسيم المجموعات)\n"
         "/schedule <match_id> <اليوم> <الساعة:الدقيقة> - جدولة مباراة\n"
         "/reschedule <match_id> <اليوم> <الساعة:الدقيقة> - تعديل موعد\n"
         "/unschedule <match_id> - إلغاء جدولة\n"
-        "/broadcast <رسالة> - إرسال للجميع\n"
+        "/broadcast [lang=|team=|phase=] <رسالة> - بث في الخلفية\n"
         "/backup - نسخة احتياطية\n"
-        "/matches - عرض المباريات\n"
+        "/matches [phase=|status=|from=|to=] - عرض المباريات\n"
         "/standings - عرض الترتيب\n"
+        "/archive - أرشفة البطولة المنتهية وضغط القاعدة\n"
+        "/rerate - إعادة حساب التصنيفات\n"
+        "/calibrate - معايرة صعوبة الأسئلة\n"
         "/help - هذه المساعدة"
     )
     await update.message.reply_text(text)
@@ -754,7 +2299,7 @@ async def owner_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------ أوامر اللاعبين ------------------
 async def player_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db_execute("INSERT OR IGNORE INTO users (user_id, username, first_name, lang) VALUES (?, ?, ?, ?)",
+    await database.execute("INSERT OR IGNORE INTO users (user_id, username, first_name, lang) VALUES (?, ?, ?, ?)",
                (user.id, user.username, user.first_name, DEFAULT_LANG))
     teams = list_teams()
     if not teams:
@@ -765,6 +2310,8 @@ async def player_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         team = get_team_name(current)
         await update.message.reply_text(_(user.id, 'already_in_team', team=team))
         return
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     keyboard = [[InlineKeyboardButton(team, callback_data=f"join_{team}")] for team in teams]
     await update.message.reply_text(_(user.id, 'choose_team'), reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -785,7 +2332,8 @@ async def player_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text(_(user_id, 'already_in_team', team=team_name))
         return
     try:
-        db_insert("INSERT INTO user_team (user_id, team_id) VALUES (?, ?)", (user_id, team_id))
+        await database.insert("INSERT INTO user_team (user_id, team_id) VALUES (?, ?)", (user_id, team_id))
+        team_index.add_member(user_id, team_id)
         await query.edit_message_text(_(user_id, 'joined', team=team_name))
         user = update.effective_user
         mention = f"@{user.username}" if user.username else f"<a href='tg://user?id={user.id}'>{user.first_name}</a>"
@@ -808,19 +2356,25 @@ async def player_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(_(user_id, 'not_in_team'))
         return
     team_name = get_team_name(team_id)
-    db_execute("DELETE FROM user_team WHERE user_id = ?", (user_id,))
+    await database.execute("DELETE FROM user_team WHERE user_id = ?", (user_id,))
+    team_index.remove_member(user_id)
     await update.message.reply_text(_(user_id, 'left', team=team_name))
 
 async def player_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     team_id = get_user_team(user_id)
     team_name = get_team_name(team_id) if team_id else "—"
-    matches = db_execute("SELECT COUNT(DISTINCT match_id) FROM player_answers WHERE user_id=?", (user_id,))[0][0]
-    correct = db_execute("SELECT COUNT(*) FROM player_answers WHERE user_id=? AND is_correct=1", (user_id,))[0][0]
-    wrong = db_execute("SELECT COUNT(*) FROM player_answers WHERE user_id=? AND is_correct=0", (user_id,))[0][0]
+    # البطولات المؤرشفة محفوظة كإجماليات في player_totals
+    matches, correct, wrong = (await database.fetch('''
+        SELECT SUM(m), SUM(c), SUM(w) FROM (
+            SELECT COUNT(DISTINCT match_id) AS m, COALESCE(SUM(is_correct = 1), 0) AS c, COALESCE(SUM(is_correct = 0), 0) AS w
+            FROM player_answers WHERE user_id=?
+            UNION ALL
+            SELECT matches, correct, wrong FROM player_totals WHERE user_id=?)
+    ''', (user_id, user_id)))[0]
     total = correct + wrong
     percent = (correct / total * 100) if total > 0 else 0
-    user_info = db_execute("SELECT first_name FROM users WHERE user_id=?", (user_id,))[0][0]
+    user_info = (await database.fetch("SELECT first_name FROM users WHERE user_id=?", (user_id,)))[0][0]
     await update.message.reply_text(
         _(user_id, 'profile', name=user_info, team=team_name, matches=matches,
           correct=correct, wrong=wrong, percent=round(percent, 2))
@@ -829,7 +2383,7 @@ async def player_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def player_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if context.args and context.args[0] in LANGUAGES:
-        set_user_lang(user_id, context.args[0])
+        await set_user_lang(user_id, context.args[0])
         await update.message.reply_text(f"✅ تم تغيير اللغة إلى {LANGUAGES[context.args[0]]}")
     else:
         await update.message.reply_text(f"❗ استخدم: /lang ar أو /lang en")
@@ -848,7 +2402,7 @@ async def player_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------ المهام المجدولة ------------------
 async def remind_match(context: ContextTypes.DEFAULT_TYPE):
     match_id = context.job.data
-    match = db_execute('''
+    match = await database.fetch('''
         SELECT t1.name, t2.name FROM matches m
         JOIN teams t1 ON m.team1_id = t1.id
         JOIN teams t2 ON m.team2_id = t2.id
@@ -857,7 +2411,7 @@ async def remind_match(context: ContextTypes.DEFAULT_TYPE):
     if not match:
         return
     team1, team2 = match[0]
-    players = db_execute('''
+    players = await database.fetch('''
         SELECT DISTINCT user_id FROM user_team ut
         JOIN matches m ON ut.team_id IN (m.team1_id, m.team2_id)
         WHERE m.id = ?
@@ -868,19 +2422,73 @@ async def remind_match(context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
+async def calibration_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_calibration()
+
+async def compaction_job(context: ContextTypes.DEFAULT_TYPE):
+    """ضغط القاعدة (وتحويلها لمرة واحدة إلى auto_vacuum تدريجي) فقط إذا لم تجرِ مباراة أو بث."""
+    if context.bot_data.get('active_matches') or broadcast_tasks:
+        return
+    freed = await database.run(compact_database, True)
+    if freed:
+        logger.info("ضغط القاعدة عند الخمول حرر %d صفحة", freed)
+
 async def check_scheduled_matches(context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now().isoformat()
-    matches = db_execute('''
+    matches = await database.fetch('''
         SELECT id FROM matches
         WHERE status = 'pending' AND played = 0 AND scheduled_time IS NOT NULL AND scheduled_time <= ?
     ''', (now,))
     for (match_id,) in matches:
         await start_match_by_id(context, match_id)
+    # مباريات أجيب عن كل أسئلتها ولم يكتمل إنهاؤها (فشل حفظ الإجابات مثلاً)
+    for match_id, match_data in list(context.bot_data.get('active_matches', {}).items()):
+        if len(match_data['answered_questions']) >= len(match_data['questions']):
+            await finalize_match(context, match_id)
 
 # ------------------ التشغيل الرئيسي ------------------
-def main():
+# وقت وصول أول تحديث (perf_counter)، يُضبط مرة واحدة
+first_update_at: Optional[float] = None
+
+async def log_first_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """في المجموعة -1 قبل كل المعالجات: تسجيل الزمن من بدء العملية حتى أول تحديث."""
+    global first_update_at
+    if first_update_at is None:
+        first_update_at = time.perf_counter()
+        logger.info("أول تحديث بعد %.3f ث من بدء التشغيل", first_update_at - STARTED_AT)
+
+async def on_startup(app: Application):
+    resumed = await resume_broadcast_jobs(app.bot)
+    if resumed:
+        logger.info("استؤنفت %d مهمة بث", resumed)
+    logger.info("جاهز لاستقبال التحديثات بعد %.3f ث", time.perf_counter() - STARTED_AT)
+
+async def on_shutdown(app: Application):
+    # إيقاف البث مع حفظ المؤشر؛ يُستأنف عند التشغيل التالي
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await answer_journal.close()
+    database.close()
+
+def startup():
+    """تجهيز القاعدة والذاكرة قبل بناء التطبيق؛ init_db لا ينفذ شيئاً إذا طابق user_version."""
     init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+    replayed = answer_journal.replay()
+    if replayed:
+        logger.info("أعيد تطبيق %d إجابة من سجل الإجابات", replayed)
+    answer_journal.open()
+    warm_caches()
+    rating_book.load()
+    load_calibration()
+    database.start()
+
+def build_application() -> Application:
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, TypeHandler
+
+    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
+    app.add_handler(TypeHandler(object, log_first_update), group=-1)
 
     # أوامر المالك
     app.add_handler(CommandHandler("addteam", owner_add_team))
@@ -893,6 +2501,9 @@ def main():
     app.add_handler(CommandHandler("backup", owner_backup))
     app.add_handler(CommandHandler("matches", owner_matches))
     app.add_handler(CommandHandler("standings", owner_standings))
+    app.add_handler(CommandHandler("archive", owner_archive))
+    app.add_handler(CommandHandler("rerate", owner_rerate))
+    app.add_handler(CommandHandler("calibrate", owner_calibrate))
     app.add_handler(CommandHandler("help", owner_help))
 
     # أوامر اللاعبين
@@ -905,25 +2516,37 @@ def main():
     # معالجات الأزرار
     app.add_handler(CallbackQueryHandler(player_join_callback, pattern="^join_"))
     app.add_handler(CallbackQueryHandler(handle_answer, pattern="^ans_"))
+    app.add_handler(CallbackQueryHandler(owner_page_callback, pattern="^[ms]pg_"))
 
     # المهام المجدولة
     job_queue = app.job_queue
     if job_queue:
         job_queue.run_repeating(check_scheduled_matches, interval=60, first=10)
+        job_queue.run_repeating(calibration_job, interval=CALIBRATION_INTERVAL, first=CALIBRATION_INTERVAL)
+        job_queue.run_repeating(compaction_job, interval=COMPACTION_INTERVAL, first=COMPACTION_INTERVAL)
+    return app
+
+def main():
+    log_listener = setup_logging()
+    startup()
+    app = build_application()
 
     # تشغيل البوت
-    if os.environ.get('PYTHONANYWHERE_DOMAIN'):
-        # على PythonAnywhere نستخدم webhook
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=8080,
-            url_path=BOT_TOKEN,
-            webhook_url=f"https://{os.environ['PYTHONANYWHERE_DOMAIN']}/{BOT_TOKEN}"
-        )
-    else:
-        # محلياً أو على منصة أخرى نستخدم polling
-        logger.info("البوت يعمل بوضع polling...")
-        app.run_polling()
+    try:
+        if os.environ.get('PYTHONANYWHERE_DOMAIN'):
+            # على PythonAnywhere نستخدم webhook
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=8080,
+                url_path=BOT_TOKEN,
+                webhook_url=f"https://{os.environ['PYTHONANYWHERE_DOMAIN']}/{BOT_TOKEN}"
+            )
+        else:
+            # محلياً أو على منصة أخرى نستخدم polling
+            logger.info("البوت يعمل بوضع polling...")
+            app.run_polling()
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
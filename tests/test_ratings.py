@@ -0,0 +1,86 @@
+"""
+recompute_ratings (الحساب الدفعي في /rerate) يجب أن يطابق RatingBook.update_match
+مباراةً بمباراة، بما في ذلك لاعبون غيّروا فرقهم بين البطولات.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DB_PATH", str(tmp_path / "tournament.db"))
+    bot.init_db()
+
+
+def add_participants(rows):
+    conn = bot.sqlite3.connect(bot.DB_PATH)
+    with conn:
+        conn.executemany("INSERT INTO match_participants (match_id, user_id, team_id) VALUES (?, ?, ?)", rows)
+    conn.close()
+
+
+def sequential(history, rows):
+    book = bot.RatingBook()
+    for match_id, team1_id, team2_id, score1 in history:
+        book.update_match(team1_id, team2_id, score1,
+                          [uid for mid, uid, team in rows if mid == match_id and team == team1_id],
+                          [uid for mid, uid, team in rows if mid == match_id and team == team2_id])
+    return book.ratings, book.games
+
+
+def assert_same(batch, incremental):
+    ratings, games = batch
+    expected_ratings, expected_games = incremental
+    assert games == expected_games
+    assert ratings.keys() == expected_ratings.keys()
+    for key, rating in expected_ratings.items():
+        assert ratings[key] == pytest.approx(rating, abs=1e-9), key
+
+
+def test_player_in_two_matches_of_one_wave(db):
+    rows = [(1, 42, 1), (1, 7, 2), (2, 42, 3), (2, 8, 4)]
+    history = [(1, 1, 2, 1.0), (2, 3, 4, 1.0)]
+    add_participants(rows)
+    batch = bot.recompute_ratings(history)
+    assert batch[1][('player', 42)] == 2
+    assert_same(batch, sequential(history, rows))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_sequential_updates(db, seed):
+    rng = random.Random(seed)
+    teams = list(range(1, 9))
+    roster = {uid: rng.choice(teams) for uid in range(1, 41)}
+    history, rows = [], []
+    for match_id in range(1, 121):
+        # تغيير فرق بعض اللاعبين بين المباريات
+        for uid in rng.sample(sorted(roster), 3):
+            roster[uid] = rng.choice(teams)
+        team1_id, team2_id = rng.sample(teams, 2)
+        history.append((match_id, team1_id, team2_id, rng.choice((0.0, 0.5, 1.0))))
+        rows += [(match_id, uid, team) for uid, team in roster.items() if team in (team1_id, team2_id)]
+    add_participants(rows)
+    assert_same(bot.recompute_ratings(history), sequential(history, rows))
+
+
+def test_upgrade_backfills_empty_ratings(db):
+    rows = [(1, 42, 1), (1, 7, 2), (2, 42, 1), (2, 8, 3)]
+    add_participants(rows)
+    conn = bot.sqlite3.connect(bot.DB_PATH)
+    with conn:
+        conn.executemany("INSERT INTO teams (id, name) VALUES (?, ?)", [(1, 'a'), (2, 'b'), (3, 'c')])
+        conn.executemany("INSERT INTO matches (id, tournament_id, phase, team1_id, team2_id, played, winner_id) "
+                         "VALUES (?, 1, 'group', ?, ?, 1, ?)", [(1, 1, 2, 1), (2, 1, 3, None)])
+        conn.execute("DELETE FROM ratings")
+        conn.execute("PRAGMA user_version = 1")
+    conn.close()
+    bot.init_db()
+    book = bot.RatingBook()
+    book.load()
+    assert_same((book.ratings, book.games), sequential(bot.match_history(), rows))